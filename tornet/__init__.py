@@ -1 +1,3 @@
 from .tornet import ma_ip, change_ip, initialize_environment, change_ip_repeatedly
+from .pool import TorPool
+from .session import isolated_session, drop_isolated_session
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Load-balancing SOCKS5 front proxy over several Tor SocksPorts
+import time
+import socket
+import asyncio
+import threading
+import itertools
+
+POLICIES = ('round-robin', 'least-connections', 'lowest-latency')
+
+SOCKS_VERSION = 5
+NO_AUTH = 0x00
+USER_PASS = 0x02
+NO_ACCEPTABLE = 0xFF
+REPLY_GENERAL_FAILURE = 0x01
+REPLY_TTL_EXPIRED = 0x06
+# Replies that say more about the backend's circuit than about the
+# destination, so the request is worth repeating on another backend.
+RETRY_REPLIES = (REPLY_GENERAL_FAILURE, REPLY_TTL_EXPIRED)
+
+
+class Backend:
+    """
+    One upstream Tor SocksPort. When bound to a pool instance, the backend
+    is skipped while that instance is rotating.
+    """
+
+    alpha = 0.3
+
+    def __init__(self, host, port, instance=None):
+        self.host = host
+        self.port = port
+        self.instance = instance
+        self.active = 0
+        self.latency = None
+        self.healthy = True
+
+    def __repr__(self):
+        return f"Backend({self.host}:{self.port})"
+
+    @property
+    def rotating(self):
+        return bool(self.instance is not None and getattr(self.instance, 'rotating', False))
+
+    @property
+    def available(self):
+        return self.healthy and not self.rotating
+
+    def record_latency(self, elapsed):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += self.alpha * (elapsed - self.latency)
+
+
+def parse_address(text, default_host='127.0.0.1'):
+    host, sep, port = text.rpartition(':')
+    return (host or default_host) if sep else default_host, int(port)
+
+
+class SocksBalancer:
+    """
+    Accept SOCKS5 clients on one address and hand each connection to a
+    backend Tor SocksPort chosen by policy. The SOCKS5 handshake is
+    replayed to the backend, including username/password so Tor's
+    IsolateSOCKSAuth keeps working, and the backend's reply decides
+    whether the connection is spliced or failed over to another backend.
+
+    A backend is marked down only when it does not complete the SOCKS
+    handshake within handshake_timeout. A CONNECT that takes longer than
+    connect_timeout, or fails with a general-failure or TTL-expired reply,
+    is retried on the next backend without marking this one down, since a
+    slow destination says nothing about the backend's health.
+    """
+
+    def __init__(self, backends, host='127.0.0.1', port=9050, policy='round-robin',
+                 connect_timeout=10.0, health_interval=5.0, handshake_timeout=3.0):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown balancing policy: {policy}")
+        self.backends = list(backends)
+        self.host = host
+        self.port = port
+        self.policy = policy
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.health_interval = health_interval
+        self._cycle = itertools.count()
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @classmethod
+    def from_pool(cls, pool, **kwargs):
+        backends = [Backend('127.0.0.1', instance.socks_port, instance) for instance in pool.instances]
+        return cls(backends, **kwargs)
+
+    def candidates(self):
+        """Backends in the order they should be tried for a new client."""
+        usable = [b for b in self.backends if b.available]
+        if not usable:
+            # Everything is rotating or marked down: trying is better than refusing.
+            usable = [b for b in self.backends if b.healthy] or list(self.backends)
+        if self.policy == 'round-robin':
+            start = next(self._cycle) % len(usable)
+            return usable[start:] + usable[:start]
+        if self.policy == 'least-connections':
+            return sorted(usable, key=lambda b: b.active)
+        return sorted(usable, key=lambda b: (b.latency is not None, b.latency or 0.0))
+
+    async def _negotiate_client(self, reader, writer):
+        version, count = await reader.readexactly(2)
+        if version != SOCKS_VERSION:
+            return None
+        methods = await reader.readexactly(count)
+        credentials = None
+        if USER_PASS in methods:
+            writer.write(bytes([SOCKS_VERSION, USER_PASS]))
+            _, ulen = await reader.readexactly(2)
+            username = await reader.readexactly(ulen)
+            plen = (await reader.readexactly(1))[0]
+            password = await reader.readexactly(plen)
+            writer.write(b"\x01\x00")
+            credentials = (username, password)
+        elif NO_AUTH in methods:
+            writer.write(bytes([SOCKS_VERSION, NO_AUTH]))
+        else:
+            writer.write(bytes([SOCKS_VERSION, NO_ACCEPTABLE]))
+            return None
+        header = await reader.readexactly(4)
+        atyp = header[3]
+        if atyp == 0x01:
+            address = await reader.readexactly(4)
+        elif atyp == 0x04:
+            address = await reader.readexactly(16)
+        elif atyp == 0x03:
+            length = await reader.readexactly(1)
+            address = length + await reader.readexactly(length[0])
+        else:
+            return None
+        port = await reader.readexactly(2)
+        return credentials, header + address + port
+
+    async def _read_reply(self, reader):
+        header = await reader.readexactly(4)
+        atyp = header[3]
+        if atyp == 0x01:
+            rest = await reader.readexactly(4 + 2)
+        elif atyp == 0x04:
+            rest = await reader.readexactly(16 + 2)
+        else:
+            length = await reader.readexactly(1)
+            rest = length + await reader.readexactly(length[0] + 2)
+        return header + rest
+
+    async def _handshake(self, backend, credentials):
+        reader, writer = await asyncio.open_connection(backend.host, backend.port)
+        try:
+            method = USER_PASS if credentials else NO_AUTH
+            writer.write(bytes([SOCKS_VERSION, 1, method]))
+            if (await reader.readexactly(2))[1] != method:
+                raise ConnectionError("backend rejected authentication method")
+            if credentials:
+                username, password = credentials
+                writer.write(bytes([1, len(username)]) + username + bytes([len(password)]) + password)
+                if (await reader.readexactly(2))[1] != 0:
+                    raise ConnectionError("backend rejected credentials")
+        except Exception:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _pipe(self, reader, writer):
+        """
+        Copy reader to writer. EOF is passed on as a half-close so the
+        other direction keeps flowing; an error closes the writer outright.
+        """
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+            return
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+    async def _handle(self, client_reader, client_writer):
+        # stop() cancels open connections; end them quietly, as a cancelled
+        # connection task would otherwise be logged with a traceback.
+        try:
+            await self._relay(client_reader, client_writer)
+        except asyncio.CancelledError:
+            client_writer.close()
+
+    async def _relay(self, client_reader, client_writer):
+        try:
+            negotiated = await self._negotiate_client(client_reader, client_writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            negotiated = None
+        if negotiated is None:
+            client_writer.close()
+            return
+        credentials, request = negotiated
+
+        reply = bytes([SOCKS_VERSION, REPLY_GENERAL_FAILURE, 0, 1, 0, 0, 0, 0, 0, 0])
+        for backend in self.candidates():
+            start = time.monotonic()
+            try:
+                backend_reader, backend_writer = await asyncio.wait_for(
+                    self._handshake(backend, credentials), self.handshake_timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                backend.healthy = False
+                continue
+            try:
+                backend_writer.write(request)
+                reply = await asyncio.wait_for(self._read_reply(backend_reader), self.connect_timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                backend_writer.close()
+                continue
+            backend.record_latency(time.monotonic() - start)
+            if reply[1] == 0:
+                break
+            backend_writer.close()
+            if reply[1] not in RETRY_REPLIES:
+                break
+        else:
+            client_writer.write(reply)
+            client_writer.close()
+            return
+
+        client_writer.write(reply)
+        if reply[1] != 0:
+            client_writer.close()
+            return
+        backend.active += 1
+        try:
+            # Both directions run to their own EOF before the connection is closed.
+            await asyncio.gather(self._pipe(client_reader, backend_writer),
+                                 self._pipe(backend_reader, client_writer))
+        finally:
+            backend.active -= 1
+            backend_writer.close()
+            client_writer.close()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for backend in self.backends:
+                if backend.healthy:
+                    continue
+                try:
+                    _, writer = await asyncio.wait_for(
+                        asyncio.open_connection(backend.host, backend.port), self.handshake_timeout)
+                    writer.close()
+                    backend.healthy = True
+                except (OSError, asyncio.TimeoutError):
+                    pass
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port,
+                                                  family=socket.AF_INET if '.' in self.host else socket.AF_UNSPEC)
+        self.port = self._server.sockets[0].getsockname()[1]
+        health = asyncio.ensure_future(self._health_loop())
+        self._ready.set()
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            health.cancel()
+
+    def start_in_thread(self):
+        """Run the proxy on a background event loop and wait until it listens."""
+        self._thread = threading.Thread(target=asyncio.run, args=(self.serve(),),
+                                        name="tornet-balancer", daemon=True)
+        self._thread.start()
+        self._ready.wait(10)
+        return self
+
+    def stop(self):
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+        if self._thread is not None:
+            self._thread.join(5)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Per-country exit benchmarks (TTFB and throughput) and the ranking built on them
+import os
+import json
+import time
+import statistics
+from .geoip import CACHE_DIR
+from .session import isolated_session, drop_isolated_session, TOR_SOCKS_PROXY
+from .utils import format_exit_nodes
+
+DEFAULT_BENCH_URL = os.environ.get('TORNET_BENCH_URL', 'https://speed.cloudflare.com/__down?bytes=1000000')
+RESULTS_PATH = os.path.join(CACHE_DIR, 'bench.json')
+# Rankings older than this are ignored when picking default countries.
+RESULTS_MAX_AGE = 7 * 24 * 3600
+
+
+def measure(session, url, timeout=30, max_bytes=5 * 1024 * 1024):
+    """
+    Fetch url and return (ttfb, kB/s). TTFB runs from the request to the
+    first body byte, so it includes building the circuit.
+    """
+    start = time.monotonic()
+    ttfb = None
+    received = 0
+    with session.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(65536):
+            if ttfb is None:
+                ttfb = time.monotonic() - start
+            received += len(chunk)
+            if received >= max_bytes:
+                break
+    elapsed = time.monotonic() - start
+    if ttfb is None:
+        ttfb = elapsed
+    transfer = elapsed - ttfb
+    return ttfb, (received / 1000.0 / transfer if transfer > 0 else 0.0)
+
+
+def bench_country(controller, country, url=DEFAULT_BENCH_URL, samples=3, timeout=30, proxy=TOR_SOCKS_PROXY):
+    """
+    Restrict exits to country and time `samples` fetches of url, each on a
+    fresh isolated circuit. Returns a result dict for the results file.
+    """
+    controller.setconf({'ExitNodes': format_exit_nodes([country]), 'StrictNodes': '1'})
+    ttfbs, rates, failures = [], [], 0
+    for i in range(samples):
+        key = f"bench-{country}-{time.monotonic_ns()}-{i}"
+        try:
+            ttfb, rate = measure(isolated_session(key, proxy), url, timeout)
+            ttfbs.append(ttfb)
+            rates.append(rate)
+        except Exception:
+            failures += 1
+        finally:
+            drop_isolated_session(key, proxy)
+    return {
+        'ttfb': statistics.median(ttfbs) if ttfbs else None,
+        'throughput': statistics.median(rates) if rates else None,
+        'samples': samples,
+        'failures': failures,
+        'url': url,
+        'measured_at': time.time(),
+    }
+
+
+def bench_countries(controller, countries, url=DEFAULT_BENCH_URL, samples=3, timeout=30,
+                    proxy=TOR_SOCKS_PROXY, on_result=None):
+    """
+    Benchmark each country in turn and return {country: result}. The
+    ExitNodes and StrictNodes values in effect before the run are put
+    back afterwards.
+    """
+    results = {}
+    saved = controller.getconf('ExitNodes', 'StrictNodes')
+    try:
+        for country in countries:
+            country = country.lower()
+            results[country] = bench_country(controller, country, url, samples, timeout, proxy)
+            if on_result:
+                on_result(country, results[country])
+    finally:
+        controller.setconf(saved)
+    return results
+
+
+def load_results(path=RESULTS_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_results(results, path=RESULTS_PATH):
+    """Merge results into the stored benchmarks; the newest run per country wins."""
+    merged = load_results(path)
+    merged.update(results)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(merged, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+    return merged
+
+
+def score(result):
+    """
+    Higher is better: throughput scaled by the success ratio, divided by
+    TTFB so a fast link behind a slow circuit build does not win outright.
+    """
+    if not result.get('throughput') or not result.get('ttfb'):
+        return 0.0
+    success = 1.0 - result.get('failures', 0) / max(result.get('samples', 1), 1)
+    return result['throughput'] * success / max(result['ttfb'], 0.05)
+
+
+def rank_countries(results=None, max_age=RESULTS_MAX_AGE):
+    """Country codes from the stored benchmarks, best first, skipping stale or failed ones."""
+    results = load_results() if results is None else results
+    now = time.time()
+    scored = [(score(r), cc) for cc, r in results.items()
+              if max_age is None or now - r.get('measured_at', 0) <= max_age]
+    return [cc for s, cc in sorted(scored, reverse=True) if s > 0]
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Warm circuit pool: pre-built circuits and controller-side stream attachment
+import time
+import random
+import threading
+from collections import deque, OrderedDict
+from .control import TorControlError, parse_circuit_line, parse_stream_line
+from .relays import get_relay_index
+
+# Streams in these states wait for the controller once __LeaveStreamsUnattached is set.
+_ATTACHABLE = ('NEW', 'NEWRESOLVE', 'DETACHED')
+
+
+class WarmCircuit:
+    __slots__ = ('id', 'exit', 'country', 'built_at')
+
+    def __init__(self, circuit_id, exit_fingerprint, country, built_at):
+        self.id = circuit_id
+        self.exit = exit_fingerprint
+        self.country = country
+        self.built_at = built_at
+
+    def __repr__(self):
+        return f"WarmCircuit({self.id}, ${self.exit}, {self.country})"
+
+
+def _target_host(target):
+    host, _, port = target.rpartition(':')
+    return (host if port.isdigit() else target).strip('[]').lower()
+
+
+class StickyRoutes:
+    """
+    Destination host -> circuit id, so a host keeps its exit while other
+    traffic rotates. Entries expire after `ttl` seconds without use and
+    the least recently used host is evicted beyond `max_hosts`.
+    """
+
+    def __init__(self, ttl=600, max_hosts=1024):
+        self.ttl = ttl
+        self.max_hosts = max_hosts
+        self._routes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def get(self, host):
+        """Circuit for host, refreshing its TTL, or None if unknown or expired."""
+        now = time.monotonic()
+        with self._lock:
+            route = self._routes.get(host)
+            if route is None:
+                return None
+            if route[1] <= now:
+                del self._routes[host]
+                return None
+            self._routes[host] = (route[0], now + self.ttl)
+            self._routes.move_to_end(host)
+            return route[0]
+
+    def set(self, host, circuit_id):
+        with self._lock:
+            self._routes[host] = (circuit_id, time.monotonic() + self.ttl)
+            self._routes.move_to_end(host)
+            while len(self._routes) > self.max_hosts:
+                self._routes.popitem(last=False)
+
+    def forget(self, host):
+        with self._lock:
+            self._routes.pop(host, None)
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+    def drop_circuit(self, circuit_id):
+        """Forget every host routed over a circuit that has closed."""
+        with self._lock:
+            for host in [h for h, (c, _) in self._routes.items() if c == circuit_id]:
+                del self._routes[host]
+
+    def circuits(self):
+        """Circuit ids still referenced by an unexpired route."""
+        now = time.monotonic()
+        with self._lock:
+            for host in [h for h, (_, expires) in self._routes.items() if expires <= now]:
+                del self._routes[host]
+            return {c for c, _ in self._routes.values()}
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return {h: {'circuit': c, 'expires_in': round(e - now, 1)}
+                    for h, (c, e) in self._routes.items() if e > now}
+
+
+class CircuitPool:
+    """
+    Keep spare circuits built ahead of time and switch identity by
+    changing which circuit new streams are attached to.
+
+    With __LeaveStreamsUnattached set, Tor hands every new stream to the
+    controller. Streams without SOCKS credentials go to the active
+    circuit; isolated streams (and everything while no circuit is active)
+    are attached with circuit 0 so Tor picks and keeps its isolation
+    rules. rotate() promotes a spare that has already completed its
+    handshakes, so the first request after a rotation does not wait for a
+    circuit build and no NEWNYM is needed. The previous circuit is closed
+    once its streams have finished, and a replacement spare is built in
+    the background.
+
+    With countries, `size` spares are kept per country and their exits
+    are chosen from the relay index; otherwise Tor picks the path.
+
+    With sticky routes, a destination host stays on the circuit its first
+    stream used until the route expires, across rotations. Circuits left
+    behind by a rotation stay open while any host is still routed to them.
+    Tor closes idle circuits once they have been dirty for
+    MaxCircuitDirtiness, so it is raised to at least the route TTL while
+    the pool runs. Routes only survive rotations done through rotate();
+    a NEWNYM still lets Tor close idle circuits.
+    """
+
+    def __init__(self, controller, size=2, countries=None, index=None, max_age=600, sticky=None):
+        self.controller = controller
+        self.size = size
+        self.countries = [cc.lower() for cc in countries] if countries else [None]
+        self.index = index
+        self.max_age = max_age
+        self.sticky = sticky
+        self.active = None
+        self.rotations = 0
+        self._ready = deque()
+        self._pending = {}
+        self._retired = set()
+        self._lock = threading.Lock()
+        self._running = False
+        self._saved_dirtiness = None
+
+    def _keep_sticky_circuits(self):
+        if self.sticky is None:
+            return
+        if self._saved_dirtiness is None:
+            self._saved_dirtiness = self.controller.getconf('MaxCircuitDirtiness')
+        current = self._saved_dirtiness.get('MaxCircuitDirtiness')
+        current = int(current) if current and current.isdigit() else 600
+        if self.sticky.ttl > current:
+            self.controller.setconf({'MaxCircuitDirtiness': str(int(self.sticky.ttl) + 1)})
+
+    def start(self):
+        self._running = True
+        self.controller.setconf({'__LeaveStreamsUnattached': '1'})
+        self._keep_sticky_circuits()
+        self.controller.add_event_listener('CIRC', self._on_circ, background=True)
+        self.controller.add_event_listener('STREAM', self._on_stream)
+        self.fill()
+        return self
+
+    def stop(self):
+        self._running = False
+        try:
+            self.controller.remove_event_listener('STREAM', self._on_stream)
+            self.controller.remove_event_listener('CIRC', self._on_circ)
+            self.controller.setconf({'__LeaveStreamsUnattached': None})
+            if self._saved_dirtiness is not None:
+                self.controller.setconf(self._saved_dirtiness)
+        except TorControlError:
+            pass
+        with self._lock:
+            spares = [c.id for c in self._ready] + list(self._pending)
+            self._ready = deque()
+            self._pending.clear()
+        for circuit_id in spares:
+            self._close(circuit_id)
+
+    def reset(self):
+        """
+        Forget every circuit after Tor restarted, since they died with the
+        old process, and build new spares on the new one.
+        """
+        with self._lock:
+            self._ready = deque()
+            self._pending.clear()
+            self._retired.clear()
+            self.active = None
+        if self.sticky is not None:
+            self.sticky.clear()
+        if self._running:
+            self.controller.setconf({'__LeaveStreamsUnattached': '1'})
+            self._keep_sticky_circuits()
+            self.fill()
+
+    def spares(self, country=None):
+        with self._lock:
+            return [c for c in self._ready if country is None or c.country == country]
+
+    def fill(self):
+        """Start builds until every country has `size` spares ready or pending."""
+        # Held across EXTENDCIRCUIT so a BUILT event cannot be handled
+        # before the circuit is registered as pending.
+        with self._lock:
+            for country in self.countries:
+                have = sum(1 for c in self._ready if c.country == country or country is None)
+                have += sum(1 for c in self._pending.values() if c == country)
+                for _ in range(self.size - have):
+                    if not self._running:
+                        return
+                    try:
+                        circuit_id = self.controller.extend_circuit(self._path(country))
+                    except TorControlError:
+                        break
+                    self._pending[circuit_id] = country
+
+    def _path(self, country):
+        """guard, middle, exit for a country-specific circuit; None lets Tor choose."""
+        if country is None:
+            return None
+        index = self.index or get_relay_index()
+        exits = index.exits(country=country, port=443)
+        guards = self.controller.entry_guards()
+        if not exits or not guards:
+            return None
+        exit_relay = random.choices(exits, weights=[r.bandwidth or 1 for r in exits], k=1)[0]
+        guard = guards[0]
+        middles = [r for r in index.with_flags(('Fast', 'Stable', 'Running', 'Valid'))
+                   if r.fingerprint not in (guard, exit_relay.fingerprint)]
+        if not middles:
+            return None
+        middle = random.choices(middles, weights=[r.bandwidth or 1 for r in middles], k=1)[0]
+        return [guard, middle.fingerprint, exit_relay.fingerprint]
+
+    def _on_circ(self, event_type, content):
+        circuit = parse_circuit_line(content.split('\n', 1)[0])
+        circuit_id, status = circuit['id'], circuit['status']
+        refill = False
+        with self._lock:
+            if status == 'BUILT' and circuit_id in self._pending and circuit['path']:
+                country = self._pending.pop(circuit_id)
+                exit_fingerprint = circuit['path'][-1][0]
+                if country is None:
+                    relay = (self.index or get_relay_index()).get(exit_fingerprint)
+                    country = relay.country if relay is not None else None
+                self._ready.append(WarmCircuit(circuit_id, exit_fingerprint, country, time.monotonic()))
+            elif status in ('FAILED', 'CLOSED'):
+                self._retired.discard(circuit_id)
+                if self.sticky is not None:
+                    self.sticky.drop_circuit(circuit_id)
+                refill = self._pending.pop(circuit_id, False) is not False
+                before = len(self._ready)
+                self._ready = deque(c for c in self._ready if c.id != circuit_id)
+                refill = refill or len(self._ready) != before
+                if self.active is not None and self.active.id == circuit_id:
+                    self.active = None
+        if refill and self._running:
+            self.fill()
+
+    def _on_stream(self, event_type, content):
+        stream = parse_stream_line(content.split('\n', 1)[0])
+        if stream['status'] == 'SUCCEEDED' and self.sticky is not None and not stream.get('SOCKS_USERNAME'):
+            # Learn the circuit Tor chose for hosts routed with circuit 0.
+            host = _target_host(stream['target'])
+            if self.sticky.get(host) is None:
+                self.sticky.set(host, stream['circuit'])
+            return
+        if stream['status'] not in _ATTACHABLE:
+            return
+        if self._retired:
+            self.reap()
+        circuit_id = self.route(stream)
+        try:
+            self.controller.attach_stream(stream['id'], circuit_id)
+        except TorControlError:
+            if circuit_id != '0':
+                try:
+                    self.controller.attach_stream(stream['id'], '0')
+                except TorControlError:
+                    pass
+
+    def route(self, stream):
+        """Circuit id for a stream waiting to be attached; '0' lets Tor choose."""
+        if stream.get('SOCKS_USERNAME'):
+            return '0'
+        if self.sticky is not None:
+            host = _target_host(stream['target'])
+            if stream['status'] == 'DETACHED':
+                self.sticky.forget(host)
+            else:
+                circuit_id = self.sticky.get(host)
+                if circuit_id is not None:
+                    return circuit_id
+        active = self.active
+        if active is None or stream['status'] == 'DETACHED':
+            return '0'
+        return active.id
+
+    def rotate(self, country=None):
+        """
+        Make a ready spare the active circuit and return it. When no spare
+        (for country, if given) is ready, the active circuit is released
+        so new streams go wherever Tor attaches them after the caller's
+        NEWNYM, and None is returned.
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            chosen = None
+            for circuit in list(self._ready):
+                if now - circuit.built_at > self.max_age:
+                    self._ready.remove(circuit)
+                    expired.append(circuit)
+                elif chosen is None and (country is None or circuit.country == country.lower()):
+                    chosen = circuit
+            if chosen is not None:
+                self._ready.remove(chosen)
+                self.rotations += 1
+            previous, self.active = self.active, chosen
+        for circuit in expired:
+            self._close(circuit.id)
+        if previous is not None:
+            with self._lock:
+                self._retired.add(previous.id)
+        self.reap()
+        threading.Thread(target=self.fill, name='tornet-circuit-fill', daemon=True).start()
+        return chosen
+
+    def reap(self):
+        """
+        Close circuits replaced by a rotation once no sticky route uses
+        them. Streams still on them keep them open until they end.
+        """
+        in_use = self.sticky.circuits() if self.sticky is not None else set()
+        with self._lock:
+            done = [c for c in self._retired if c not in in_use]
+            self._retired.difference_update(done)
+        for circuit_id in done:
+            self._close(circuit_id, if_unused=True)
+
+    def _close(self, circuit_id, if_unused=False):
+        try:
+            self.controller.close_circuit(circuit_id, if_unused=if_unused)
+        except TorControlError:
+            pass
+
+    def exit_fingerprint(self):
+        active = self.active
+        return active.exit if active is not None else None
+
+    def stats(self):
+        with self._lock:
+            stats = {'active': self.active.id if self.active else None, 'ready': len(self._ready),
+                     'building': len(self._pending), 'retired': len(self._retired), 'rotations': self.rotations}
+        if self.sticky is not None:
+            stats['sticky_hosts'] = len(self.sticky)
+        return stats
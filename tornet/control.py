@@ -0,0 +1,654 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Minimal client for the Tor control protocol (control-spec.txt)
+import os
+import hmac
+import time
+import queue
+import socket
+import hashlib
+import threading
+
+DEFAULT_CONTROL_HOST = os.environ.get('TORNET_CONTROL_HOST', '127.0.0.1')
+DEFAULT_CONTROL_PORT = int(os.environ.get('TORNET_CONTROL_PORT', 9051))
+DEFAULT_CONTROL_PASSWORD = os.environ.get('TORNET_CONTROL_PASSWORD')
+
+SAFECOOKIE_SERVER_KEY = b"Tor safe cookie authentication server-to-controller hash"
+SAFECOOKIE_CLIENT_KEY = b"Tor safe cookie authentication controller-to-server hash"
+
+
+class TorControlError(Exception):
+    """Raised when the control port is unreachable or rejects a command."""
+
+
+def _quote(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return value
+
+
+def _parse_keywords(text):
+    """Parse 'KEY=value KEY2="quoted value"' pairs from a reply line."""
+    result = {}
+    i = 0
+    while i < len(text):
+        while i < len(text) and text[i] == ' ':
+            i += 1
+        start = i
+        while i < len(text) and text[i] not in ' =':
+            i += 1
+        key = text[start:i]
+        if not key:
+            break
+        if i < len(text) and text[i] == '=':
+            i += 1
+            if i < len(text) and text[i] == '"':
+                end = i + 1
+                while end < len(text) and text[end] != '"':
+                    end += 2 if text[end] == '\\' else 1
+                result[key] = _unquote(text[i:end + 1])
+                i = end + 1
+            else:
+                start = i
+                while i < len(text) and text[i] != ' ':
+                    i += 1
+                result[key] = text[start:i]
+        else:
+            result[key] = None
+    return result
+
+
+def parse_circuit_line(line):
+    """
+    Parse one circuit-status line, e.g.
+    '12 BUILT $FP1~nick1,$FP2~nick2 BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL'.
+    """
+    parts = line.split(' ', 3)
+    circuit = {'id': parts[0], 'status': parts[1] if len(parts) > 1 else '', 'path': []}
+    rest = ' '.join(parts[2:])
+    if rest and '=' not in rest.split(' ', 1)[0]:
+        path, _, rest = rest.partition(' ')
+        for hop in path.split(','):
+            fingerprint, _, nickname = hop.lstrip('$').replace('=', '~').partition('~')
+            circuit['path'].append((fingerprint, nickname))
+    circuit.update(_parse_keywords(rest))
+    return circuit
+
+
+def parse_stream_line(line):
+    """
+    Parse a stream-status line or STREAM event, e.g.
+    '42 NEW 0 example.com:443 SOURCE_ADDR=127.0.0.1:50312 PURPOSE=USER'.
+    """
+    parts = line.split(' ', 4)
+    stream = {
+        'id': parts[0],
+        'status': parts[1] if len(parts) > 1 else '',
+        'circuit': parts[2] if len(parts) > 2 else '0',
+        'target': parts[3] if len(parts) > 3 else '',
+    }
+    stream.update(_parse_keywords(parts[4] if len(parts) > 4 else ''))
+    return stream
+
+
+def parse_router_line(line):
+    """
+    Parse a consensus 'r' line. Full consensuses carry a descriptor digest
+    that microdescriptor consensuses omit, so fields are located relative
+    to the publication time rather than by fixed position.
+    """
+    fields = line.split()
+    time_index = next(i for i, f in enumerate(fields) if f.count(':') == 2 and i > 2)
+    return {
+        'nickname': fields[1],
+        'identity': fields[2],
+        'published': fields[time_index - 1] + ' ' + fields[time_index],
+        'address': fields[time_index + 1],
+        'or_port': int(fields[time_index + 2]),
+        'dir_port': int(fields[time_index + 3]),
+    }
+
+
+class TorController:
+    """
+    A small, thread-safe Tor control port connection.
+
+    Replies are returned as a list of (status, line) tuples; data blocks
+    ("250+key=" ... ".") are joined into the line that introduced them.
+    Once an event listener is added, a reader thread owns the socket:
+    command replies are handed back to msg() and asynchronous 650 events
+    are passed to listeners on a separate dispatch thread, so listeners
+    may issue commands themselves. Listeners added with background=True
+    run on a worker thread instead, so slow ones cannot hold up the rest.
+    """
+
+    def __init__(self, host=DEFAULT_CONTROL_HOST, port=DEFAULT_CONTROL_PORT,
+                 password=DEFAULT_CONTROL_PASSWORD, cookie_path=None, timeout=10):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.cookie_path = cookie_path
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.RLock()
+        self._handlers = {}
+        self._background = set()
+        self._replies = None
+        self._events = None
+        self._reader = None
+        # Highest circuit id seen before the last NEWNYM; circuits up to it
+        # belong to the previous identity.
+        self._newnym_mark = None
+        self.closed = threading.Event()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def is_connected(self):
+        return self._sock is not None
+
+    def connect(self):
+        with self._lock:
+            if self._sock is not None:
+                return self
+            try:
+                self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            except OSError as e:
+                self._sock = None
+                raise TorControlError(f"Cannot connect to control port {self.host}:{self.port}: {e}")
+            self._file = self._sock.makefile('rb')
+            self.closed.clear()
+            # Circuit ids restart with a new Tor process.
+            self._newnym_mark = None
+            try:
+                self.authenticate()
+                if self._handlers:
+                    # Re-subscribe after a reconnect.
+                    self._start_reader()
+                    self._set_events()
+            except Exception:
+                self.close()
+                raise
+            return self
+
+    def close(self):
+        # Deliberately lock-free: the reader thread calls this while a
+        # command may be holding the lock and waiting for its reply.
+        sock, stream = self._sock, self._file
+        self._sock = self._file = None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for obj in (stream, sock):
+            try:
+                if obj is not None:
+                    obj.close()
+            except OSError:
+                pass
+        for channel in (self._replies, self._events):
+            if channel is not None:
+                channel.put(None)
+        self._replies = self._events = self._reader = None
+        self.closed.set()
+
+    def _readline(self):
+        stream = self._file
+        if stream is None:
+            raise TorControlError("Not connected to the control port")
+        try:
+            line = stream.readline()
+        except (OSError, ValueError) as e:
+            self.close()
+            raise TorControlError(f"Control connection lost: {e}")
+        if not line:
+            self.close()
+            raise TorControlError("Control connection closed by Tor")
+        return line.decode('utf-8', 'replace').rstrip('\r\n')
+
+    def _read_reply(self):
+        reply = []
+        while True:
+            line = self._readline()
+            status, sep, rest = line[:3], line[3:4], line[4:]
+            if sep == '+':
+                data = []
+                while True:
+                    data_line = self._readline()
+                    if data_line == '.':
+                        break
+                    data.append(data_line[1:] if data_line.startswith('..') else data_line)
+                rest = rest + '\n' + '\n'.join(data)
+            reply.append((status, rest))
+            if sep == ' ':
+                return reply
+
+    def msg(self, command):
+        """Send a raw command and return its reply, raising on non-2xx status."""
+        with self._lock:
+            if self._sock is None:
+                raise TorControlError("Not connected to the control port")
+            replies = self._replies
+            try:
+                self._sock.sendall(command.encode('utf-8') + b"\r\n")
+            except OSError as e:
+                self.close()
+                raise TorControlError(f"Control connection lost: {e}")
+            if replies is not None:
+                try:
+                    reply = replies.get(timeout=self.timeout)
+                except queue.Empty:
+                    # A late reply would be read as the answer to the next
+                    # command; start over on a fresh connection instead.
+                    self.close()
+                    raise TorControlError(f"Timed out waiting for reply to {command.split(' ')[0]}")
+                if reply is None:
+                    raise TorControlError("Control connection lost")
+            else:
+                reply = self._read_reply()
+                while reply[0][0] == '650':
+                    reply = self._read_reply()
+        status = reply[-1][0]
+        if not status.startswith('2'):
+            raise TorControlError(f"{command.split(' ')[0]} failed: {status} {reply[-1][1]}")
+        return reply
+
+    def add_event_listener(self, event_type, handler, background=False):
+        """
+        Subscribe handler(event_type, content) to an asynchronous event
+        such as 'NEWCONSENSUS', 'NS', 'CIRC' or 'STATUS_CLIENT'. Use
+        background=True for handlers that send slow commands.
+        """
+        with self._lock:
+            self._handlers.setdefault(event_type.upper(), []).append(handler)
+            if background:
+                self._background.add(handler)
+            self._start_reader()
+            self._set_events()
+
+    def remove_event_listener(self, event_type, handler):
+        with self._lock:
+            handlers = self._handlers.get(event_type.upper(), [])
+            if handler in handlers:
+                handlers.remove(handler)
+            if not any(handler in h for h in self._handlers.values()):
+                self._background.discard(handler)
+            if not handlers:
+                self._handlers.pop(event_type.upper(), None)
+            if self.is_connected:
+                self._set_events()
+
+    def _set_events(self):
+        self.msg("SETEVENTS " + " ".join(sorted(self._handlers)))
+
+    def _start_reader(self):
+        if self._reader is not None or self._sock is None:
+            return
+        self._sock.settimeout(None)
+        self._replies, self._events = queue.Queue(), queue.Queue()
+        self._reader = threading.Thread(target=self._read_loop, args=(self._replies, self._events),
+                                        name='tornet-control-reader', daemon=True)
+        self._reader.start()
+        work = queue.Queue()
+        threading.Thread(target=self._dispatch_loop, args=(self._events, work),
+                         name='tornet-control-events', daemon=True).start()
+        threading.Thread(target=self._work_loop, args=(work,),
+                         name='tornet-control-worker', daemon=True).start()
+
+    def _read_loop(self, replies, events):
+        while True:
+            try:
+                reply = self._read_reply()
+            except TorControlError:
+                break
+            (events if reply[0][0] == '650' else replies).put(reply)
+        replies.put(None)
+        events.put(None)
+
+    @staticmethod
+    def _call(handler, event_type, content):
+        try:
+            handler(event_type, content)
+        except Exception:
+            pass
+
+    def _work_loop(self, work):
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            self._call(*item)
+
+    def _dispatch_loop(self, events, work):
+        while True:
+            reply = events.get()
+            if reply is None:
+                work.put(None)
+                return
+            if len(reply) > 1 and reply[-1][1] == 'OK':
+                reply = reply[:-1]
+            first_line, newline, data = reply[0][1].partition('\n')
+            event_type, _, args = first_line.partition(' ')
+            event_type = event_type.upper()
+            parts = [args] if args else []
+            if newline:
+                parts.append(data)
+            content = '\n'.join(parts + [line for _, line in reply[1:]])
+            for handler in list(self._handlers.get(event_type, [])):
+                if handler in self._background:
+                    work.put((handler, event_type, content))
+                else:
+                    self._call(handler, event_type, content)
+
+    def protocolinfo(self):
+        info = {}
+        for _, line in self.msg("PROTOCOLINFO 1"):
+            name, _, rest = line.partition(' ')
+            if name == 'AUTH':
+                info.update(_parse_keywords(rest))
+        return info
+
+    def authenticate(self):
+        info = self.protocolinfo()
+        methods = (info.get('METHODS') or '').split(',')
+        cookie_file = self.cookie_path or info.get('COOKIEFILE')
+
+        if 'NULL' in methods:
+            self.msg("AUTHENTICATE")
+        elif 'HASHEDPASSWORD' in methods and self.password is not None:
+            self.msg("AUTHENTICATE " + _quote(self.password))
+        elif cookie_file and ('COOKIE' in methods or 'SAFECOOKIE' in methods):
+            try:
+                with open(cookie_file, 'rb') as f:
+                    cookie = f.read()
+            except OSError as e:
+                raise TorControlError(f"Cannot read control auth cookie {cookie_file}: {e}")
+            if 'COOKIE' in methods:
+                self.msg("AUTHENTICATE " + cookie.hex())
+            else:
+                self._authenticate_safecookie(cookie)
+        else:
+            raise TorControlError("No usable control port authentication method "
+                                  "(set TORNET_CONTROL_PASSWORD or enable CookieAuthentication)")
+
+    def _authenticate_safecookie(self, cookie):
+        client_nonce = os.urandom(32)
+        reply = self.msg("AUTHCHALLENGE SAFECOOKIE " + client_nonce.hex())
+        fields = _parse_keywords(reply[-1][1].partition(' ')[2])
+        server_hash = bytes.fromhex(fields.get('SERVERHASH', ''))
+        server_nonce = bytes.fromhex(fields.get('SERVERNONCE', ''))
+        expected = hmac.new(SAFECOOKIE_SERVER_KEY, cookie + client_nonce + server_nonce, hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, server_hash):
+            raise TorControlError("SAFECOOKIE server hash mismatch")
+        client_hash = hmac.new(SAFECOOKIE_CLIENT_KEY, cookie + client_nonce + server_nonce, hashlib.sha256).digest()
+        self.msg("AUTHENTICATE " + client_hash.hex())
+
+    def getinfo(self, *keys):
+        """Return a dict mapping each requested GETINFO key to its value."""
+        result = {}
+        for _, line in self.msg("GETINFO " + " ".join(keys)):
+            key, sep, value = line.partition('=')
+            if sep:
+                result[key] = value.lstrip('\n') if '\n' in value else value
+        return result
+
+    def signal(self, name):
+        self.msg("SIGNAL " + name)
+
+    def getconf(self, *keys):
+        """Current values of torrc options; None for options left at their default."""
+        values = {}
+        for _, line in self.msg("GETCONF " + " ".join(keys)):
+            key, sep, value = line.partition('=')
+            values[key] = _unquote(value) if sep else None
+        return values
+
+    def setconf(self, options):
+        """Change torrc options at runtime, e.g. {'ExitNodes': '{de}'}."""
+        parts = []
+        for key, value in options.items():
+            if value is None:
+                parts.append(key)
+            else:
+                value = str(value)
+                if not value or any(c in value for c in ' "\\'):
+                    value = _quote(value)
+                parts.append(f"{key}={value}")
+        self.msg("SETCONF " + " ".join(parts))
+
+    def circuit_status(self):
+        """Return the open circuits as a list of parsed circuit-status lines."""
+        text = self.getinfo('circuit-status').get('circuit-status', '')
+        return [parse_circuit_line(line) for line in text.splitlines() if line.strip()]
+
+    def extend_circuit(self, path=None, purpose=None):
+        """
+        Build a new circuit, through the given relay fingerprints if path
+        is set, and return its id. Completion is reported by CIRC events.
+        """
+        command = "EXTENDCIRCUIT 0"
+        if path:
+            command += " " + ",".join('$' + fp.lstrip('$') for fp in path)
+        if purpose:
+            command += " purpose=" + purpose
+        reply = self.msg(command)
+        words = reply[-1][1].split()
+        if len(words) < 2 or words[0] != 'EXTENDED':
+            raise TorControlError(f"Unexpected EXTENDCIRCUIT reply: {reply[-1][1]}")
+        return words[1]
+
+    def close_circuit(self, circuit_id, if_unused=False):
+        self.msg(f"CLOSECIRCUIT {circuit_id}" + (" IfUnused" if if_unused else ""))
+
+    def attach_stream(self, stream_id, circuit_id='0'):
+        """Attach a stream to a circuit; circuit '0' lets Tor choose."""
+        self.msg(f"ATTACHSTREAM {stream_id} {circuit_id}")
+
+    def stream_status(self):
+        """Return the open streams as a list of parsed stream-status lines."""
+        text = self.getinfo('stream-status').get('stream-status', '')
+        return [parse_stream_line(line) for line in text.splitlines() if line.strip()]
+
+    def close_stream(self, stream_id, reason=1):
+        """Close a stream; reason is a RELAY_END code (1 = misc)."""
+        self.msg(f"CLOSESTREAM {stream_id} {reason}")
+
+    def entry_guards(self):
+        """Fingerprints of the entry guards Tor currently considers usable."""
+        text = self.getinfo('entry-guards').get('entry-guards', '')
+        guards = []
+        for line in text.splitlines():
+            words = line.split()
+            if len(words) >= 2 and words[1] == 'up':
+                guards.append(words[0].lstrip('$').split('~')[0].split('=')[0])
+        return guards
+
+    def exit_fingerprint(self, wait=2.0):
+        """
+        Fingerprint of the exit relay of the newest built general-purpose
+        circuit created after the last NEWNYM sent on this connection.
+        Circuits from before it stay BUILT (only dirty) for a while, so
+        they are skipped; if no new circuit is built within `wait`
+        seconds, None is returned and callers fall back to HTTP.
+        """
+        deadline = time.monotonic() + wait
+        while True:
+            mark = self._newnym_mark
+            candidates = [c for c in self.circuit_status()
+                          if c['status'] == 'BUILT' and c['path']
+                          and c.get('PURPOSE', 'GENERAL') == 'GENERAL'
+                          and (mark is None or int(c['id']) > mark)
+                          and not {'IS_INTERNAL', 'ONEHOP_TUNNEL'} & set((c.get('BUILD_FLAGS') or '').split(','))]
+            if candidates:
+                newest = max(candidates, key=lambda c: int(c['id']))
+                return newest['path'][-1][0]
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.25)
+
+    def relay_address(self, fingerprint):
+        """Look up a relay's address in Tor's cached consensus (no network)."""
+        try:
+            entry = self.getinfo(f'ns/id/{fingerprint}').get(f'ns/id/{fingerprint}', '')
+        except TorControlError:
+            return None
+        for line in entry.splitlines():
+            if line.startswith('r '):
+                return parse_router_line(line)['address']
+        return None
+
+    def ip_country(self, address):
+        """Country code for an address from Tor's bundled GeoIP database."""
+        key = f'ip-to-country/{address}'
+        try:
+            country = self.getinfo(key).get(key)
+        except TorControlError:
+            return None
+        return None if not country or country == '??' else country
+
+    def bootstrap_phase(self):
+        """
+        Keywords of GETINFO status/bootstrap-phase, e.g. {'PROGRESS': '85',
+        'TAG': 'ap_handshake_done', 'SUMMARY': '...'}.
+        """
+        phase = self.getinfo('status/bootstrap-phase').get('status/bootstrap-phase', '')
+        return _parse_keywords(phase.split(' ', 2)[-1])
+
+    def bootstrap_progress(self):
+        """Bootstrap percentage reported by GETINFO status/bootstrap-phase."""
+        return int(self.bootstrap_phase().get('PROGRESS') or 0)
+
+    def is_ready(self):
+        """True once Tor is fully bootstrapped and has built a circuit."""
+        if self.bootstrap_progress() < 100:
+            return False
+        try:
+            established = self.getinfo('status/circuit-established').get('status/circuit-established')
+        except TorControlError:
+            # Older or restricted Tor: look for a built circuit instead.
+            return any(c['status'] == 'BUILT' for c in self.circuit_status())
+        return established == '1'
+
+    def wait_for_bootstrap(self, timeout=300, on_progress=None):
+        """
+        Block until bootstrap reaches 100% or timeout passes, following
+        STATUS_CLIENT BOOTSTRAP events and re-checking GETINFO every few
+        seconds in case an event is missed. on_progress(percent, phase)
+        is called whenever the percentage changes. Returns True if ready.
+        """
+        deadline = time.monotonic() + timeout
+        done = threading.Event()
+        last = [-1]
+
+        def update(phase):
+            progress = int(phase.get('PROGRESS') or 0)
+            if progress != last[0]:
+                last[0] = progress
+                if on_progress:
+                    on_progress(progress, phase)
+            if progress >= 100:
+                done.set()
+
+        def on_status(event_type, content):
+            severity, _, rest = content.partition(' ')
+            action, _, arguments = rest.partition(' ')
+            if action == 'BOOTSTRAP':
+                update(_parse_keywords(arguments))
+
+        try:
+            self.add_event_listener('STATUS_CLIENT', on_status)
+            while not done.is_set():
+                update(self.bootstrap_phase())
+                remaining = deadline - time.monotonic()
+                if done.is_set() or remaining <= 0:
+                    break
+                done.wait(min(2.0, remaining))
+        finally:
+            try:
+                self.remove_event_listener('STATUS_CLIENT', on_status)
+            except TorControlError:
+                pass
+        return done.is_set()
+
+    def exit_address(self):
+        """Return the exit IP of the active circuit, or None if unknown."""
+        fingerprint = self.exit_fingerprint()
+        return self.relay_address(fingerprint) if fingerprint else None
+
+    def newnym(self):
+        """Ask Tor to switch to clean circuits for new connections."""
+        try:
+            mark = max((int(c['id']) for c in self.circuit_status()), default=0)
+        except (TorControlError, ValueError):
+            # Without a mark no circuit can be told apart as new.
+            mark = float('inf')
+        self.signal("NEWNYM")
+        self._newnym_mark = mark
+
+
+_shared_controller = None
+_shared_lock = threading.Lock()
+
+
+def get_controller():
+    """
+    Return a connected controller shared by the module-level helpers,
+    reconnecting if the previous connection was dropped.
+    """
+    global _shared_controller
+    with _shared_lock:
+        if _shared_controller is None:
+            _shared_controller = TorController()
+        if not _shared_controller.is_connected:
+            _shared_controller.connect()
+        return _shared_controller
+
+
+def send_newnym():
+    """
+    Request a new identity over the control port.
+
+    :return: True if Tor acknowledged the signal, False if the control
+             port could not be used.
+    """
+    try:
+        get_controller().newnym()
+        return True
+    except TorControlError:
+        return False
+
+
+def wait_until_ready(timeout=300, on_progress=None):
+    """
+    Wait for the control port to accept connections and for Tor to finish
+    bootstrapping. Returns True once ready, False on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return get_controller().wait_for_bootstrap(max(0.0, deadline - time.monotonic()), on_progress)
+        except TorControlError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.5)
+
+
+def tor_ready():
+    """Readiness probe: True if Tor is bootstrapped and has a working circuit."""
+    try:
+        return get_controller().is_ready()
+    except TorControlError:
+        return False
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Exit diversity guard: reject exits, subnets and ASNs that were used recently
+import os
+import array
+import bisect
+import threading
+import ipaddress
+from collections import OrderedDict, Counter
+
+# Optional offline IP-to-ASN table in the iptoasn.com ip2asn-v4.tsv format.
+ASN_DB_PATH = os.environ.get('TORNET_ASN_DB')
+
+
+class ASNTable:
+    """IPv4 range table mapping addresses to AS numbers, searched by bisect."""
+
+    def __init__(self, starts, ends, asns):
+        self.starts = starts
+        self.ends = ends
+        self.asns = asns
+
+    def __len__(self):
+        return len(self.starts)
+
+    def asn(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version != 4:
+            return None
+        value = int(address)
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i] and self.asns[i]:
+            return self.asns[i]
+        return None
+
+    @classmethod
+    def load(cls, path):
+        rows = []
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                fields = line.split('\t')
+                if len(fields) < 3 or line.startswith('#'):
+                    continue
+                try:
+                    rows.append((int(ipaddress.IPv4Address(fields[0])), int(ipaddress.IPv4Address(fields[1])),
+                                 int(fields[2])))
+                except ValueError:
+                    continue
+        rows.sort()
+        return cls(array.array('I', (r[0] for r in rows)), array.array('I', (r[1] for r in rows)),
+                   array.array('I', (r[2] for r in rows)))
+
+
+def _prefixes(ip, lengths):
+    """Integer keys for the IPv4 prefixes of ip, e.g. (24, value >> 8)."""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ()
+    if address.version != 4:
+        return ()
+    value = int(address)
+    return tuple((length, value >> (32 - length)) for length in lengths)
+
+
+class DiversityGuard:
+    """
+    Remember the last `size` exits and reject a new exit if it repeats one
+    of them, shares a /24 or /16 with one of them, or sits in the same AS.
+
+    Prefixes and ASNs are reference-counted integers derived from the LRU,
+    so they age out together with the exits that put them there. The
+    Rotator consults check() after each rotation and re-rotates up to
+    `retries` times; remember() records whichever exit is finally kept.
+    """
+
+    def __init__(self, size=32, prefixes=(24, 16), asn_table=None, retries=3):
+        self.size = size
+        self.prefix_lengths = tuple(sorted(prefixes, reverse=True))
+        self.asn_table = asn_table
+        self.retries = retries
+        self.rejected = Counter()
+        self._recent = OrderedDict()
+        self._prefixes = Counter()
+        self._asns = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, size=32, prefixes=(24, 16), retries=3):
+        table = ASNTable.load(ASN_DB_PATH) if ASN_DB_PATH and os.path.exists(ASN_DB_PATH) else None
+        return cls(size, prefixes, table, retries)
+
+    def _asn(self, ip):
+        return self.asn_table.asn(ip) if self.asn_table is not None else None
+
+    def check(self, ip):
+        """Return why ip is not diverse enough ('exit', 'subnet/24', 'asn'), or None."""
+        with self._lock:
+            if ip in self._recent:
+                return 'exit'
+            for length, key in _prefixes(ip, self.prefix_lengths):
+                if self._prefixes[(length, key)]:
+                    return f"subnet/{length}"
+            asn = self._asn(ip)
+            if asn is not None and self._asns[asn]:
+                return 'asn'
+        return None
+
+    def reject(self, reason):
+        """Count an exit turned down for reason."""
+        with self._lock:
+            self.rejected[reason] += 1
+
+    def remember(self, ip):
+        with self._lock:
+            if ip in self._recent:
+                self._recent.move_to_end(ip)
+                return
+            asn = self._asn(ip)
+            self._recent[ip] = asn
+            self._prefixes.update(_prefixes(ip, self.prefix_lengths))
+            if asn is not None:
+                self._asns[asn] += 1
+            while len(self._recent) > self.size:
+                old, old_asn = self._recent.popitem(last=False)
+                self._prefixes.subtract(_prefixes(old, self.prefix_lengths))
+                if old_asn is not None:
+                    self._asns[old_asn] -= 1
+                self._prefixes += Counter()
+                self._asns += Counter()
+
+    def stats(self):
+        with self._lock:
+            return {'recent': len(self._recent), 'prefixes': len(self._prefixes),
+                    'asns': len(self._asns), 'rejected': dict(self.rejected)}
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Wait for in-flight streams before a rotation and account for the ones left over
+import time
+from .control import TorControlError
+from .metrics import STREAMS_DRAINED, STREAMS_CUT, STREAMS_CARRIED
+
+# Streams in these states are carrying or about to carry client traffic.
+ACTIVE_STREAM_STATES = ('NEW', 'NEWRESOLVE', 'SENTCONNECT', 'SENTRESOLVE', 'SUCCEEDED', 'REMAP')
+
+
+class DrainResult:
+    __slots__ = ('drained', 'cut', 'carried', 'waited')
+
+    def __init__(self, drained=0, cut=0, carried=0, waited=0.0):
+        self.drained = drained
+        self.cut = cut
+        self.carried = carried
+        self.waited = waited
+
+    def __bool__(self):
+        return bool(self.drained or self.cut or self.carried)
+
+    def as_dict(self):
+        return {'drained': self.drained, 'cut': self.cut, 'carried': self.carried, 'waited': round(self.waited, 3)}
+
+
+def active_streams(controller):
+    return {s['id'] for s in controller.stream_status() if s['status'] in ACTIVE_STREAM_STATES}
+
+
+def drain_streams(controller, deadline, cut=False, poll_interval=0.25, name='default'):
+    """
+    Wait up to `deadline` seconds for the streams open right now to finish.
+
+    Streams opened while waiting are not waited for. At the deadline the
+    stragglers are closed when cut is set; otherwise they are left on
+    their current circuit, which NEWNYM does not tear down, and only new
+    connections move to the next identity.
+    """
+    start = time.monotonic()
+    try:
+        waiting = active_streams(controller)
+    except TorControlError:
+        return DrainResult()
+    initial = len(waiting)
+    while waiting and time.monotonic() - start < deadline:
+        time.sleep(min(poll_interval, max(0.0, deadline - (time.monotonic() - start))))
+        try:
+            waiting &= active_streams(controller)
+        except TorControlError:
+            break
+    result = DrainResult(drained=initial - len(waiting), waited=time.monotonic() - start)
+    for stream_id in waiting:
+        if cut:
+            try:
+                controller.close_stream(stream_id)
+                result.cut += 1
+                continue
+            except TorControlError:
+                pass
+        result.carried += 1
+    STREAMS_DRAINED.inc(result.drained, instance=name)
+    STREAMS_CUT.inc(result.cut, instance=name)
+    STREAMS_CARRIED.inc(result.carried, instance=name)
+    return result
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Hedged public-IP lookup across several echo services
+import os
+import time
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from .session import get_session, TOR_SOCKS_PROXY
+from .metrics import PROBE_SECONDS
+
+
+def _parse_text(response):
+    return response.text.strip()
+
+
+def _parse_torproject(response):
+    return response.json().get('IP', '')
+
+
+# name -> (url, parser)
+ECHO_SERVICES = {
+    'ipify': ('https://api.ipify.org', _parse_text),
+    'torproject': ('https://check.torproject.org/api/ip', _parse_torproject),
+    'ipinfo': ('https://ipinfo.io/ip', _parse_text),
+}
+DEFAULT_BACKENDS = [name.strip() for name in os.environ.get('TORNET_ECHO_BACKENDS', '').split(',')
+                    if name.strip()] or list(ECHO_SERVICES)
+
+
+class EchoBackend:
+    """One echo service plus a smoothed latency estimate used for ranking."""
+
+    alpha = 0.3
+
+    def __init__(self, name, url, parser=_parse_text):
+        self.name = name
+        self.url = url
+        self.parser = parser
+        self.latency = None
+        self.successes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed, ok):
+        with self._lock:
+            if ok:
+                self.successes += 1
+            else:
+                self.failures += 1
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += self.alpha * (elapsed - self.latency)
+
+    @property
+    def score(self):
+        # Untried backends sort first so every backend gets measured.
+        return 0.0 if self.latency is None else self.latency
+
+    def fetch(self, session, timeout):
+        response = session.get(self.url, timeout=timeout)
+        response.raise_for_status()
+        ip = self.parser(response).strip()
+        ipaddress.ip_address(ip)
+        return ip
+
+
+def make_backend(spec):
+    """Build a backend from a known service name or a plain-text echo URL."""
+    spec = spec.strip()
+    if spec in ECHO_SERVICES:
+        url, parser = ECHO_SERVICES[spec]
+        return EchoBackend(spec, url, parser)
+    return EchoBackend(spec, spec)
+
+
+class IPResolver:
+    """
+    Ask several echo services for the public IP and keep the first valid
+    answer. The fastest-known backend is queried first; each further
+    backend is only started if no answer arrived within hedge_delay.
+    Attempts that have not started yet are cancelled once an answer
+    arrives. Hedged attempts only get the time left until the lookup's
+    deadline, so one that loses the race does not hold a worker much
+    longer than the lookup itself.
+    """
+
+    def __init__(self, backends=None, proxy=TOR_SOCKS_PROXY, timeout=10.0, hedge_delay=1.0):
+        self.backends = [b if isinstance(b, EchoBackend) else make_backend(b)
+                         for b in (backends or DEFAULT_BACKENDS) if isinstance(b, EchoBackend) or b.strip()]
+        self.proxy = proxy
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        # Room for two overlapping lookups to hedge across every backend.
+        self._executor = ThreadPoolExecutor(max_workers=2 * max(1, len(self.backends)),
+                                            thread_name_prefix='tornet-echo')
+
+    def ranked(self):
+        return sorted(self.backends, key=lambda b: b.score)
+
+    def _attempt(self, backend, timeout):
+        start = time.monotonic()
+        try:
+            ip = backend.fetch(get_session(self.proxy), timeout)
+        except Exception:
+            elapsed = time.monotonic() - start
+            PROBE_SECONDS.observe(elapsed, backend=backend.name, result='error')
+            # A failure counts as a full timeout so broken backends sink.
+            backend.record(max(elapsed, self.timeout), False)
+            raise
+        elapsed = time.monotonic() - start
+        PROBE_SECONDS.observe(elapsed, backend=backend.name, result='ok')
+        backend.record(elapsed, True)
+        return backend, ip
+
+    def lookup(self):
+        """
+        :return: (ip, backend_name) from the first backend to answer, or
+                 (None, None) if every backend failed within the timeout.
+        """
+        deadline = time.monotonic() + self.timeout
+        queue = self.ranked()
+        pending = set()
+        try:
+            while queue or pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if queue:
+                    pending.add(self._executor.submit(self._attempt, queue.pop(0), remaining))
+                wait_for = min(self.hedge_delay, remaining) if queue else remaining
+                done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        backend, ip = future.result()
+                        return ip, backend.name
+            return None, None
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def stats(self):
+        return {b.name: {'latency': b.latency, 'successes': b.successes, 'failures': b.failures}
+                for b in self.backends}
+
+
+tor_resolver = IPResolver(proxy=TOR_SOCKS_PROXY)
+direct_resolver = IPResolver(proxy=None, timeout=5.0)
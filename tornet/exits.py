@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Exit selection: bandwidth-weighted exit pinning and per-rotation country plans
+import time
+import random
+import threading
+from .relays import get_relay_index
+
+PLAN_STRATEGIES = ('round-robin', 'weighted', 'random')
+
+
+class ExitSelector:
+    """
+    Pick exits in proportion to their bandwidth and pin them with
+    ExitNodes. Weights start from the consensus bandwidth (kB/s); once an
+    exit has been measured, its weight is the average of the consensus
+    figure and the measured throughput, so exits that under-deliver lose
+    weight. Exits below min_bandwidth are never picked.
+    """
+
+    alpha = 0.5
+
+    def __init__(self, index=None, countries=None, min_bandwidth=0, port=443, avoid_last=True):
+        self.index = index
+        self.countries = [cc.lower() for cc in countries] if countries else None
+        self.min_bandwidth = min_bandwidth
+        self.port = port
+        self.avoid_last = avoid_last
+        self.measured = {}
+        self.current = None
+        self._lock = threading.Lock()
+
+    def candidates(self, countries=None):
+        index = self.index or get_relay_index()
+        countries = [cc.lower() for cc in countries] if countries else self.countries or [None]
+        relays = []
+        for country in countries:
+            relays.extend(index.exits(country=country, port=self.port, min_bandwidth=self.min_bandwidth))
+        return relays
+
+    def why_empty(self, countries=None):
+        """Explain why candidates() found nothing, for error messages."""
+        index = self.index or get_relay_index()
+        countries = [cc.lower() for cc in countries] if countries else self.countries or [None]
+        where = f" in {','.join(countries)}" if countries != [None] else ''
+        exits = [r for cc in countries for r in index.exits(country=cc)]
+        if not exits:
+            return f"no exit relays{where} in the cached consensus"
+        if not any(r.policy is not None for r in exits):
+            return "no exit policies are loaded (the microdescriptors are missing)"
+        if not any(r.allows_port(self.port) for r in exits):
+            return f"no exit relays{where} allow port {self.port}"
+        return f"no exit relays{where} at or above {self.min_bandwidth} kB/s"
+
+    def weight(self, relay):
+        measured = self.measured.get(relay.fingerprint)
+        if measured is None:
+            return float(relay.bandwidth)
+        return (relay.bandwidth + measured) / 2.0
+
+    def choose(self, exclude=(), countries=None):
+        """
+        Return a bandwidth-weighted random exit Relay, or None. countries
+        overrides the selector's own list for this pick only.
+        """
+        excluded = set(exclude)
+        if self.avoid_last and self.current is not None:
+            excluded.add(self.current.fingerprint)
+        candidates = self.candidates(countries)
+        relays = [r for r in candidates if r.fingerprint not in excluded] or candidates
+        weights = [self.weight(r) for r in relays]
+        if not relays or not any(weights):
+            return None
+        return random.choices(relays, weights=weights, k=1)[0]
+
+    def record_throughput(self, fingerprint, kbytes_per_second):
+        """Fold a throughput measurement (kB/s) into the exit's weight."""
+        with self._lock:
+            previous = self.measured.get(fingerprint)
+            if previous is None:
+                self.measured[fingerprint] = kbytes_per_second
+            else:
+                self.measured[fingerprint] = previous + self.alpha * (kbytes_per_second - previous)
+
+    def pin(self, controller, relay):
+        """Restrict Tor to this exit; the caller sends NEWNYM afterwards."""
+        controller.setconf({'ExitNodes': '$' + relay.fingerprint, 'StrictNodes': '1'})
+        self.current = relay
+        return relay
+
+
+class CountryPlan:
+    """
+    Decide which country each rotation exits from.
+
+    round-robin walks the list in order; weighted draws countries in
+    proportion to their weights ('us:3,de:1'); random shuffles the list
+    and deals it out so every country is used once per pass, without the
+    same country twice in a row across passes.
+    """
+
+    def __init__(self, countries, strategy='round-robin', weights=None):
+        if strategy not in PLAN_STRATEGIES:
+            raise ValueError(f"unknown country plan: {strategy}")
+        if not countries:
+            raise ValueError("a country plan needs at least one country")
+        self.countries = [cc.lower() for cc in countries]
+        self.strategy = strategy
+        self.weights = list(weights) if weights else [1.0] * len(self.countries)
+        self.current = None
+        self._position = 0
+        self._bag = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec, strategy='round-robin'):
+        """Build a plan from 'us,de,fr' or, with weights, 'us:3,de:1,fr:1'."""
+        countries, weights = [], []
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            country, _, weight = item.partition(':')
+            countries.append(country.strip())
+            weights.append(float(weight) if weight else 1.0)
+        return cls(countries, strategy, weights)
+
+    def next(self):
+        with self._lock:
+            if self.strategy == 'round-robin':
+                country = self.countries[self._position % len(self.countries)]
+                self._position += 1
+            elif self.strategy == 'weighted':
+                country = random.choices(self.countries, weights=self.weights, k=1)[0]
+            else:
+                if not self._bag:
+                    self._bag = random.sample(self.countries, len(self.countries))
+                    if len(self._bag) > 1 and self._bag[-1] == self.current:
+                        self._bag[0], self._bag[-1] = self._bag[-1], self._bag[0]
+                country = self._bag.pop()
+            self.current = country
+            return country
+
+
+def measure_throughput(session, url, timeout=30, max_bytes=5 * 1024 * 1024):
+    """
+    Download up to max_bytes from url and return the rate in kB/s, or None
+    if the transfer failed.
+    """
+    start = time.monotonic()
+    received = 0
+    try:
+        with session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(65536):
+                received += len(chunk)
+                if received >= max_bytes:
+                    break
+    except Exception:
+        return None
+    elapsed = time.monotonic() - start
+    return received / 1000.0 / elapsed if elapsed > 0 and received else None
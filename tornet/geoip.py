@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Offline country lookup from Tor's bundled geoip/geoip6 range files
+import os
+import mmap
+import array
+import bisect
+import struct
+import threading
+import ipaddress
+
+GEOIP_SEARCH_PATHS = ['/usr/share/tor', '/usr/local/share/tor', '/opt/homebrew/share/tor']
+CACHE_DIR = os.environ.get('TORNET_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'tornet'))
+
+_MAGIC = b'TNGEOIP1'
+# magic, v4 source size/mtime, v6 source size/mtime, v4 count, v6 count, country count
+_HEADER = struct.Struct('=8sqqqqIII')
+
+
+def find_geoip_file(name):
+    override = os.environ.get('TORNET_' + name.upper())
+    if override:
+        return override
+    for directory in GEOIP_SEARCH_PATHS:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _source_stamp(path):
+    try:
+        st = os.stat(path)
+        return st.st_size, int(st.st_mtime)
+    except (OSError, TypeError):
+        return 0, 0
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+class _Packed16:
+    """Sequence view over packed 16-byte big-endian IPv6 keys, for bisect."""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        return len(self.buffer) // 16
+
+    def __getitem__(self, index):
+        return bytes(self.buffer[index * 16:index * 16 + 16])
+
+
+class GeoIPIndex:
+    """
+    Sorted range tables built from Tor's geoip files. IPv4 ranges are kept
+    as parallel uint32 arrays, IPv6 ranges as packed 16-byte keys, and each
+    range points into a small country table. Lookups are a binary search.
+    """
+
+    def __init__(self, v4_start, v4_end, v4_country, v6_start, v6_end, v6_country, countries):
+        self.v4_start = v4_start
+        self.v4_end = v4_end
+        self.v4_country = v4_country
+        self.v6_start = _Packed16(v6_start)
+        self.v6_end = _Packed16(v6_end)
+        self.v6_country = v6_country
+        self.countries = countries
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.v4_start) + len(self.v6_start)
+
+    def country(self, ip):
+        """Return the lower-case country code for ip, or None if unknown."""
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 4:
+            value = int(address)
+            i = bisect.bisect_right(self.v4_start, value) - 1
+            if i >= 0 and value <= self.v4_end[i]:
+                return self.countries[self.v4_country[i]]
+            return None
+        key = address.packed
+        i = bisect.bisect_right(self.v6_start, key) - 1
+        if i >= 0 and key <= self.v6_end[i]:
+            return self.countries[self.v6_country[i]]
+        return None
+
+    @classmethod
+    def parse(cls, geoip_path, geoip6_path=None):
+        countries, country_ids = [], {}
+
+        def country_id(code):
+            code = code.strip().lower()
+            if code not in country_ids:
+                country_ids[code] = len(countries)
+                countries.append(code)
+            return country_ids[code]
+
+        v4 = []
+        if geoip_path and os.path.exists(geoip_path):
+            with open(geoip_path) as f:
+                for line in f:
+                    if line.startswith('#') or ',' not in line:
+                        continue
+                    low, high, code = line.split(',', 2)
+                    v4.append((int(low), int(high), country_id(code)))
+        v6 = []
+        if geoip6_path and os.path.exists(geoip6_path):
+            with open(geoip6_path) as f:
+                for line in f:
+                    if line.startswith('#') or ',' not in line:
+                        continue
+                    low, high, code = line.split(',', 2)
+                    v6.append((ipaddress.IPv6Address(low).packed, ipaddress.IPv6Address(high).packed,
+                               country_id(code)))
+        v4.sort()
+        v6.sort()
+        return cls(
+            array.array('I', (r[0] for r in v4)), array.array('I', (r[1] for r in v4)),
+            array.array('H', (r[2] for r in v4)),
+            b''.join(r[0] for r in v6), b''.join(r[1] for r in v6),
+            array.array('H', (r[2] for r in v6)),
+            countries,
+        )
+
+    def save(self, path, geoip_path, geoip6_path):
+        """Write the index in a layout that load_cache can memory-map."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        country_blob = ','.join(self.countries).encode('ascii')
+        header = _HEADER.pack(_MAGIC, *_source_stamp(geoip_path), *_source_stamp(geoip6_path),
+                              len(self.v4_start), len(self.v6_start), len(country_blob))
+        sections = [header, country_blob, self.v4_start.tobytes(), self.v4_end.tobytes(),
+                    self.v4_country.tobytes(), self.v6_start.buffer, self.v6_end.buffer,
+                    self.v6_country.tobytes()]
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for section in sections:
+                f.write(section)
+                f.write(b'\0' * (_align(f.tell()) - f.tell()))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load_cache(cls, path, geoip_path, geoip6_path):
+        """
+        Map a cache written by save(). Returns None when the cache is
+        missing or was built from different source files.
+        """
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+        with f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+        if len(mapped) < _HEADER.size:
+            return None
+        magic, v4_size, v4_mtime, v6_size, v6_mtime, n4, n6, clen = _HEADER.unpack_from(mapped, 0)
+        if magic != _MAGIC or (v4_size, v4_mtime) != _source_stamp(geoip_path) \
+                or (v6_size, v6_mtime) != _source_stamp(geoip6_path):
+            return None
+        view = memoryview(mapped)
+        offset = _align(_HEADER.size)
+        countries = bytes(view[offset:offset + clen]).decode('ascii').split(',') if clen else []
+        offset = _align(offset + clen)
+        sections = []
+        for size, fmt in ((n4 * 4, 'I'), (n4 * 4, 'I'), (n4 * 2, 'H'), (n6 * 16, None), (n6 * 16, None), (n6 * 2, 'H')):
+            chunk = view[offset:offset + size]
+            sections.append(chunk.cast(fmt) if fmt else chunk)
+            offset = _align(offset + size)
+        index = cls(*sections, countries)
+        index._mmap = mapped
+        return index
+
+    @classmethod
+    def load(cls, geoip_path=None, geoip6_path=None, cache_path=None):
+        """Load from the memory-mapped cache, rebuilding it when stale."""
+        geoip_path = geoip_path or find_geoip_file('geoip')
+        geoip6_path = geoip6_path or find_geoip_file('geoip6')
+        cache_path = cache_path or os.path.join(CACHE_DIR, 'geoip.idx')
+        index = cls.load_cache(cache_path, geoip_path, geoip6_path)
+        if index is None:
+            index = cls.parse(geoip_path, geoip6_path)
+            try:
+                index.save(cache_path, geoip_path, geoip6_path)
+            except OSError:
+                pass
+        return index
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = GeoIPIndex.load()
+        return _index
+
+
+def lookup_country(ip):
+    """Country code for ip from Tor's local GeoIP files, or None."""
+    return get_index().country(ip)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# In-process metrics served in the Prometheus text exposition format
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for k, v in labels)
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self.register(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.register(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+ROTATION_SECONDS = REGISTRY.histogram('tornet_rotation_seconds', 'Time to send a rotation and confirm the new exit.')
+ROTATIONS = REGISTRY.counter('tornet_rotations_total', 'Rotations performed.')
+ROTATIONS_FAILED = REGISTRY.counter('tornet_rotations_failed_total', 'Rotations that did not yield an exit IP.')
+ROTATIONS_NOOP = REGISTRY.counter('tornet_rotations_noop_total', 'Rotations that reported the same exit IP as before.')
+ROTATIONS_COALESCED = REGISTRY.counter('tornet_rotations_coalesced_total', 'Rotation requests merged into another rotation.')
+ROTATIONS_RETRIED = REGISTRY.counter('tornet_rotations_retried_total', 'Rotations repeated because the exit was not diverse enough.')
+STREAMS_DRAINED = REGISTRY.counter('tornet_streams_drained_total', 'Streams that finished while a rotation waited for them.')
+STREAMS_CUT = REGISTRY.counter('tornet_streams_cut_total', 'Streams closed because they outlived the drain deadline.')
+STREAMS_CARRIED = REGISTRY.counter('tornet_streams_carried_total', 'Streams left running on their old circuit after a rotation.')
+IP_VERIFICATIONS = REGISTRY.counter('tornet_ip_verifications_total', 'Control-port exit IPs checked over HTTP, by result (match or mismatch).')
+PROBE_SECONDS = REGISTRY.histogram('tornet_probe_seconds', 'IP echo probe latency per backend.')
+BOOTSTRAP_SECONDS = REGISTRY.histogram('tornet_bootstrap_seconds', 'Time for a Tor process to reach 100% bootstrap.',
+                                       buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300))
+BOOTSTRAP_PHASE_SECONDS = REGISTRY.histogram('tornet_bootstrap_phase_seconds', 'Time spent in each Tor bootstrap phase.',
+                                             buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120))
+TOR_RESTARTS = REGISTRY.counter('tornet_tor_restarts_total', 'Supervised Tor processes that exited and were restarted.')
+TOR_UP = REGISTRY.gauge('tornet_tor_up', 'Whether the supervised Tor process is running.')
+UNIQUE_EXITS = REGISTRY.gauge('tornet_unique_exits', 'Distinct exit IPs seen since start.')
+EXITS_BY_COUNTRY = REGISTRY.counter('tornet_exits_total', 'Exits observed after rotation, by country.')
+
+_seen_exits = set()
+_seen_lock = threading.Lock()
+
+
+def record_exit(ip, country=None):
+    """Count an exit observed after a rotation."""
+    with _seen_lock:
+        _seen_exits.add(ip)
+        UNIQUE_EXITS.set(len(_seen_exits))
+    EXITS_BY_COUNTRY.inc(country=(country or 'unknown').lower())
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(address='127.0.0.1:9153', registry=REGISTRY):
+    """Serve /metrics on [HOST:]PORT from a background thread."""
+    host, _, port = str(address).rpartition(':')
+    server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='tornet-metrics', daemon=True).start()
+    return server
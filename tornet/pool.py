@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Pool of independent Tor processes, one SocksPort/ControlPort each
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from .control import TorController, TorControlError
+from .session import invalidate_tor_sessions
+from .echo import IPResolver
+from .scheduler import Scheduler
+from .rotation import Rotator
+from .metrics import BOOTSTRAP_SECONDS, record_exit
+from .utils import format_exit_nodes
+
+DEFAULT_SOCKS_BASE = 9060
+DEFAULT_CONTROL_BASE = 9160
+
+
+class TorInstance:
+    """A single tor process with its own torrc, DataDirectory and ports."""
+
+    def __init__(self, index, base_dir, socks_port, control_port, countries=None, tor_binary='tor'):
+        self.index = index
+        self.socks_port = socks_port
+        self.control_port = control_port
+        self.countries = countries
+        self.tor_binary = tor_binary
+        self.directory = os.path.join(base_dir, f"tor{index}")
+        self.data_dir = os.path.join(self.directory, "data")
+        self.torrc_path = os.path.join(self.directory, "torrc")
+        self.proxy = f"socks5://127.0.0.1:{socks_port}"
+        self.resolver = IPResolver(proxy=self.proxy)
+        self.process = None
+        self.current_ip = None
+        self.rotations = 0
+        self.rotating = False
+        # Optional CountryPlan shared across the pool; consulted per rotation.
+        self.country_plan = None
+        self._controller = None
+        self._rotator = Rotator(self._rotate_once, name=f"tor{index}")
+        self._started = None
+
+    def torrc(self):
+        lines = [
+            f"SocksPort 127.0.0.1:{self.socks_port}",
+            f"ControlPort 127.0.0.1:{self.control_port}",
+            "CookieAuthentication 1",
+            f"DataDirectory {self.data_dir}",
+            "RunAsDaemon 0",
+            "Log notice file " + os.path.join(self.directory, "notice.log"),
+        ]
+        if self.countries:
+            lines.append("ExitNodes " + format_exit_nodes(self.countries))
+            lines.append("StrictNodes 1")
+        return "\n".join(lines) + "\n"
+
+    def write_torrc(self):
+        os.makedirs(self.data_dir, mode=0o700, exist_ok=True)
+        os.chmod(self.data_dir, 0o700)
+        with open(self.torrc_path, "w") as torrc:
+            torrc.write(self.torrc())
+
+    def start(self):
+        self.write_torrc()
+        self.process = subprocess.Popen(
+            [self.tor_binary, "-f", self.torrc_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        self._started = time.monotonic()
+        return self
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self._controller is not None:
+            self._controller.close()
+            self._controller = None
+        if self.is_alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+    def controller(self):
+        if self._controller is None or not self._controller.is_connected:
+            self._controller = TorController(
+                port=self.control_port,
+                cookie_path=os.path.join(self.data_dir, "control_auth_cookie"),
+            ).connect()
+        return self._controller
+
+    def wait_for_control(self, timeout=60):
+        """Wait until the control port answers and Tor is fully bootstrapped."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.is_alive():
+                return False
+            try:
+                if self.controller().bootstrap_progress() >= 100:
+                    BOOTSTRAP_SECONDS.observe(time.monotonic() - self._started, instance=f"tor{self.index}")
+                    return True
+            except TorControlError:
+                pass
+            time.sleep(0.5)
+        return False
+
+    def rotate(self):
+        """
+        Send NEWNYM to this instance and return its new exit IP; requests
+        inside the NEWNYM rate-limit window share one rotation.
+        """
+        return self._rotator.rotate()
+
+    def _rotate_once(self):
+        self.rotating = True
+        try:
+            if self.country_plan is not None:
+                self.countries = [self.country_plan.next()]
+                self.controller().setconf({'ExitNodes': format_exit_nodes(self.countries), 'StrictNodes': '1'})
+            self.controller().newnym()
+            invalidate_tor_sessions(self.proxy)
+            self.rotations += 1
+            self.current_ip, _ = self.resolver.lookup()
+            if self.current_ip:
+                record_exit(self.current_ip, self.controller().ip_country(self.current_ip))
+        finally:
+            self.rotating = False
+        return self.current_ip
+
+
+class TorPool:
+    """
+    Spawn and supervise several Tor instances. Each instance rotates on
+    its own thread and schedule, so the pool exposes one exit per instance
+    at any time.
+    """
+
+    def __init__(self, size, base_dir=None, socks_base=DEFAULT_SOCKS_BASE,
+                 control_base=DEFAULT_CONTROL_BASE, countries=None, tor_binary='tor', country_plan=None,
+                 guard=None):
+        self._owns_dir = base_dir is None
+        self.base_dir = base_dir or tempfile.mkdtemp(prefix="tornet-pool-")
+        self.instances = [
+            TorInstance(i, self.base_dir, socks_base + i, control_base + i, countries, tor_binary)
+            for i in range(size)
+        ]
+        for instance in self.instances:
+            instance.country_plan = country_plan
+            instance._rotator.guard = guard
+        self.scheduler = None
+        # Held while an instance is restarted so stop() cannot race with it.
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def proxies(self):
+        return [instance.proxy for instance in self.instances]
+
+    def start(self, timeout=60):
+        """
+        Start every instance and return those that bootstrapped within
+        timeout. If one cannot be started at all, the ones already running
+        are stopped again and an OSError naming that instance is raised.
+        """
+        for instance in self.instances:
+            try:
+                instance.start()
+            except OSError as e:
+                with self._lock:
+                    for started in self.instances:
+                        started.stop()
+                raise OSError(f"Cannot start Tor instance {instance.index} ({instance.tor_binary}): {e}") from e
+        return [instance for instance in self.instances if instance.wait_for_control(timeout)]
+
+    def _supervise(self, instance):
+        with self._lock:
+            if self._stopping or instance.is_alive():
+                return
+            instance.stop()
+            instance.start()
+        instance.wait_for_control()
+
+    def _rotation_job(self, instance, on_rotate):
+        def rotate():
+            try:
+                self._supervise(instance)
+                ip = instance.rotate()
+            except (TorControlError, OSError):
+                # OSError: the tor binary could not be started again.
+                ip = None
+            if on_rotate:
+                on_rotate(instance, ip)
+        return rotate
+
+    def run(self, interval, count, on_rotate=None, block=True, jitter=0):
+        """
+        Rotate every instance independently.
+
+        :param interval: Seconds, a 'min-max' range or a cron expression;
+                         a list gives each instance its own schedule.
+        :param count: Rotations per instance; 0 rotates until stop().
+        :param on_rotate: Optional callback(instance, ip) after each rotation.
+        """
+        intervals = interval if isinstance(interval, (list, tuple)) else [interval] * len(self.instances)
+        self.scheduler = Scheduler().start()
+        for instance, schedule in zip(self.instances, intervals):
+            self.scheduler.add(self._rotation_job(instance, on_rotate), schedule, count=count,
+                               name=f"tor{instance.index}", jitter=jitter)
+        if block:
+            self.scheduler.wait()
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        with self._lock:
+            for instance in self.instances:
+                instance.stop()
+        if self._owns_dir:
+            shutil.rmtree(self.base_dir, ignore_errors=True)
@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Relay index built from Tor's cached consensus
+import os
+import time
+import json
+import base64
+import hashlib
+import threading
+import datetime
+from .geoip import lookup_country, CACHE_DIR
+from .control import get_controller, TorControlError
+
+# Clients use the microdesc flavour; a full consensus may be a stale leftover.
+CONSENSUS_FILES = ('cached-microdesc-consensus', 'cached-consensus')
+
+DATA_DIR_CANDIDATES = ['/var/lib/tor', os.path.join(os.path.expanduser('~'), '.tor')]
+
+FLAG_NAMES = ('Authority', 'BadExit', 'Exit', 'Fast', 'Guard', 'HSDir', 'MiddleOnly',
+              'NoEdConsensus', 'Running', 'Stable', 'StaleDesc', 'Sybil', 'V2Dir', 'Valid')
+FLAG_BITS = {name: 1 << i for i, name in enumerate(FLAG_NAMES)}
+EXIT_FLAGS = ('Exit', 'Running', 'Valid')
+
+_CACHE_VERSION = 2
+_HEADER_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def flags_to_mask(flags):
+    mask = 0
+    for flag in flags:
+        mask |= FLAG_BITS.get(flag, 0)
+    return mask
+
+
+def mask_to_flags(mask):
+    return [name for name, bit in FLAG_BITS.items() if mask & bit]
+
+
+def identity_to_fingerprint(identity):
+    """Convert a consensus base64 identity to the hex fingerprint."""
+    return base64.b64decode(identity + '=' * (-len(identity) % 4)).hex().upper()
+
+
+def parse_policy_summary(text):
+    """'accept 80,443,8000-8100' -> (True, ((80, 80), (443, 443), (8000, 8100)))"""
+    action, _, ports = text.strip().partition(' ')
+    ranges = []
+    for part in ports.split(','):
+        if not part:
+            continue
+        low, _, high = part.partition('-')
+        ranges.append((int(low), int(high or low)))
+    return action == 'accept', tuple(ranges)
+
+
+class Relay:
+    """One consensus entry; __slots__ keeps ~7000 of these small."""
+
+    __slots__ = ('fingerprint', 'nickname', 'address', 'or_port', 'flags',
+                 'bandwidth', 'country', 'policy', 'microdesc')
+
+    def __init__(self, fingerprint, nickname, address, or_port, flags=0,
+                 bandwidth=0, country=None, policy=None, microdesc=None):
+        self.fingerprint = fingerprint
+        self.nickname = nickname
+        self.address = address
+        self.or_port = or_port
+        self.flags = flags
+        self.bandwidth = bandwidth
+        self.country = country
+        self.policy = policy
+        self.microdesc = microdesc
+
+    def __repr__(self):
+        return f"Relay({self.nickname} {self.fingerprint[:8]} {self.address} {self.country} bw={self.bandwidth})"
+
+    def to_json(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_json(cls, fields):
+        relay = cls(*fields)
+        if relay.policy is not None:
+            accept, ranges = relay.policy
+            relay.policy = (bool(accept), tuple((int(low), int(high)) for low, high in ranges))
+        return relay
+
+    def has_flags(self, mask):
+        return self.flags & mask == mask
+
+    @property
+    def is_exit(self):
+        return self.has_flags(flags_to_mask(EXIT_FLAGS)) and not self.flags & FLAG_BITS['BadExit']
+
+    def allows_port(self, port):
+        if self.policy is None:
+            return False
+        accept, ranges = self.policy
+        matched = any(low <= port <= high for low, high in ranges)
+        return matched if accept else not matched
+
+
+def parse_consensus(text):
+    """
+    Parse a full or microdescriptor-flavoured consensus document.
+
+    :return: (header dict with valid-after/fresh-until/valid-until, list of Relay)
+    """
+    header = {}
+    relays = []
+    relay = None
+    for line in text.splitlines():
+        keyword, _, rest = line.partition(' ')
+        if keyword == 'r':
+            fields = rest.split()
+            time_index = next(i for i, f in enumerate(fields) if f.count(':') == 2 and i > 1)
+            relay = Relay(identity_to_fingerprint(fields[1]), fields[0],
+                          fields[time_index + 1], int(fields[time_index + 2]))
+            relays.append(relay)
+        elif relay is None:
+            if keyword in ('valid-after', 'fresh-until', 'valid-until'):
+                header[keyword] = datetime.datetime.strptime(rest.strip(), _HEADER_TIME_FORMAT)
+        elif keyword == 's':
+            relay.flags = flags_to_mask(rest.split())
+        elif keyword == 'w':
+            for item in rest.split():
+                key, _, value = item.partition('=')
+                if key == 'Bandwidth':
+                    relay.bandwidth = int(value)
+        elif keyword == 'p':
+            relay.policy = parse_policy_summary(rest)
+        elif keyword == 'm':
+            relay.microdesc = rest.split()[0].rstrip('=')
+        elif keyword == 'directory-footer':
+            relay = None
+    return header, relays
+
+
+def parse_microdesc_policies(text):
+    """
+    Map microdescriptor digests to their exit policy summary. The digest
+    is the unpadded base64 SHA-256 of the descriptor without annotations.
+    """
+    policies = {}
+    current, policy = [], None
+
+    def flush():
+        if current:
+            body = ''.join(current).encode('utf-8')
+            digest = base64.b64encode(hashlib.sha256(body).digest()).decode('ascii').rstrip('=')
+            if policy is not None:
+                policies[digest] = policy
+
+    for line in text.splitlines(keepends=True):
+        if line.startswith('@'):
+            flush()
+            current, policy = [], None
+            continue
+        if line.startswith('onion-key') and current:
+            flush()
+            current, policy = [], None
+        current.append(line)
+        if line.startswith('p '):
+            policy = parse_policy_summary(line[2:])
+    flush()
+    return policies
+
+
+def find_data_dir():
+    override = os.environ.get('TORNET_DATA_DIR')
+    if override:
+        return override
+    for directory in DATA_DIR_CANDIDATES:
+        if os.path.exists(os.path.join(directory, 'cached-microdesc-consensus')) or \
+                os.path.exists(os.path.join(directory, 'cached-consensus')):
+            return directory
+    return DATA_DIR_CANDIDATES[0]
+
+
+def read_consensus_times(path):
+    """valid-after, fresh-until and valid-until from a consensus header, without parsing the body."""
+    times = {}
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                keyword, _, rest = line.partition(' ')
+                if keyword in ('valid-after', 'fresh-until', 'valid-until'):
+                    times[keyword] = datetime.datetime.strptime(rest.strip(), _HEADER_TIME_FORMAT)
+                elif keyword in ('r', 'dir-source') or len(times) == 3:
+                    break
+    except (OSError, ValueError):
+        return {}
+    return times
+
+
+def newest_consensus(data_dir):
+    """(header times, path) of the consensus with the latest valid-until in data_dir."""
+    best_times, best_path = {}, None
+    for name in CONSENSUS_FILES:
+        path = os.path.join(data_dir, name)
+        times = read_consensus_times(path) if os.path.exists(path) else {}
+        if 'valid-until' in times and ('valid-until' not in best_times
+                                       or times['valid-until'] > best_times['valid-until']):
+            best_times, best_path = times, path
+    return best_times, best_path
+
+
+def consensus_path(data_dir):
+    """The newest cached consensus in data_dir, or the first one present if none has a readable header."""
+    path = newest_consensus(data_dir)[1]
+    if path is not None:
+        return path
+    for name in CONSENSUS_FILES:
+        path = os.path.join(data_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _stamp(*paths):
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamp.append((path, st.st_size, int(st.st_mtime)))
+        except (OSError, TypeError):
+            stamp.append((path, 0, 0))
+    return tuple(stamp)
+
+
+class RelayIndex:
+    """
+    Relays from the consensus, indexed by fingerprint, country and flag.
+    Exits per destination port are computed on first use and cached.
+    """
+
+    def __init__(self, relays=(), header=None):
+        self.header = header or {}
+        self.relays = {}
+        self.by_country = {}
+        self.by_flag = {}
+        self._port_cache = {}
+        self._lock = threading.RLock()
+        for relay in relays:
+            self.add(relay)
+
+    def __len__(self):
+        return len(self.relays)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.relays
+
+    def get(self, fingerprint):
+        return self.relays.get(fingerprint.lstrip('$').upper())
+
+    def add(self, relay):
+        with self._lock:
+            if relay.fingerprint in self.relays:
+                self.remove(relay.fingerprint)
+            if relay.country is None:
+                relay.country = lookup_country(relay.address)
+            self.relays[relay.fingerprint] = relay
+            self.by_country.setdefault(relay.country, set()).add(relay.fingerprint)
+            for name, bit in FLAG_BITS.items():
+                if relay.flags & bit:
+                    self.by_flag.setdefault(name, set()).add(relay.fingerprint)
+            self._port_cache.clear()
+
+    def remove(self, fingerprint):
+        with self._lock:
+            relay = self.relays.pop(fingerprint, None)
+            if relay is None:
+                return None
+            self.by_country.get(relay.country, set()).discard(fingerprint)
+            for members in self.by_flag.values():
+                members.discard(fingerprint)
+            self._port_cache.clear()
+            return relay
+
+    def exits(self, country=None, port=None, min_bandwidth=0, flags=()):
+        """
+        Usable exit relays, optionally limited to a country, an allowed
+        destination port, a minimum consensus bandwidth and extra flags.
+        """
+        with self._lock:
+            if port is not None:
+                if port not in self._port_cache:
+                    self._port_cache[port] = frozenset(
+                        fp for fp, r in self.relays.items() if r.is_exit and r.allows_port(port))
+                candidates = self._port_cache[port]
+            else:
+                candidates = self.by_flag.get('Exit', set())
+            if country:
+                candidates = candidates & self.by_country.get(country.lower(), set())
+            mask = flags_to_mask(flags)
+            result = [self.relays[fp] for fp in candidates]
+        return [r for r in result if r.is_exit and r.bandwidth >= min_bandwidth and r.has_flags(mask)]
+
+    def with_flags(self, flags):
+        """Relays carrying all of the given flags, e.g. ('Fast', 'Stable')."""
+        with self._lock:
+            members = None
+            for flag in flags:
+                flagged = self.by_flag.get(flag, set())
+                members = set(flagged) if members is None else members & flagged
+            return [self.relays[fp] for fp in (members if members is not None else self.relays)]
+
+    def apply_entries(self, relays, complete=False):
+        """
+        Merge router status entries into the index as a diff. Policies and
+        countries are carried over for relays whose address and descriptor
+        did not change. With complete=True the entries are a whole new
+        consensus, so relays missing from it are removed.
+
+        :return: (added, changed, removed) fingerprint lists
+        """
+        added, changed, removed = [], [], []
+        with self._lock:
+            if complete:
+                present = {relay.fingerprint for relay in relays}
+                for fingerprint in [fp for fp in self.relays if fp not in present]:
+                    self.remove(fingerprint)
+                    removed.append(fingerprint)
+            for relay in relays:
+                old = self.relays.get(relay.fingerprint)
+                if old is None:
+                    added.append(relay.fingerprint)
+                elif (old.nickname, old.address, old.or_port, old.flags, old.bandwidth, old.microdesc) == \
+                        (relay.nickname, relay.address, relay.or_port, relay.flags, relay.bandwidth,
+                         relay.microdesc or old.microdesc):
+                    continue
+                else:
+                    changed.append(relay.fingerprint)
+                    if relay.microdesc is None or relay.microdesc == old.microdesc:
+                        relay.microdesc = old.microdesc
+                        relay.policy = relay.policy or old.policy
+                    if relay.address == old.address:
+                        relay.country = old.country
+                self.add(relay)
+        return added, changed, removed
+
+    def country_summary(self, port=None):
+        """{country: (exit count, total exit bandwidth)} for usable exits."""
+        summary = {}
+        for relay in self.exits(port=port):
+            count, bandwidth = summary.get(relay.country, (0, 0))
+            summary[relay.country] = (count + 1, bandwidth + relay.bandwidth)
+        return summary
+
+    @classmethod
+    def from_files(cls, consensus_file, microdescs_files=()):
+        with open(consensus_file, encoding='utf-8', errors='replace') as f:
+            header, relays = parse_consensus(f.read())
+        policies = {}
+        for path in microdescs_files:
+            if os.path.exists(path):
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    policies.update(parse_microdesc_policies(f.read()))
+        for relay in relays:
+            if relay.policy is None and relay.microdesc:
+                relay.policy = policies.get(relay.microdesc)
+        return cls(relays, header)
+
+    def save(self, path, stamp):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': _CACHE_VERSION,
+                       'stamp': stamp,
+                       'header': {key: value.strftime(_HEADER_TIME_FORMAT) for key, value in self.header.items()},
+                       'relays': [relay.to_json() for relay in self.relays.values()]}, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, data_dir=None, cache_path=None):
+        """
+        Build the index from the DataDirectory, reusing the on-disk cache
+        while the consensus and microdescriptor files are unchanged.
+        """
+        data_dir = data_dir or find_data_dir()
+        consensus_file = consensus_path(data_dir)
+        if consensus_file is None:
+            return cls()
+        microdescs = [os.path.join(data_dir, 'cached-microdescs'),
+                      os.path.join(data_dir, 'cached-microdescs.new')]
+        stamp = _stamp(consensus_file, *microdescs)
+        cache_path = cache_path or os.path.join(CACHE_DIR, 'relays.json')
+        try:
+            # Plain JSON only: the cache dir is user-writable and tornet
+            # usually runs as root, so the cache must never carry code.
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached['version'] == _CACHE_VERSION and cached['stamp'] == json.loads(json.dumps(stamp)):
+                header = {key: datetime.datetime.strptime(value, _HEADER_TIME_FORMAT)
+                          for key, value in cached['header'].items()}
+                return cls([Relay.from_json(fields) for fields in cached['relays']], header)
+        except (OSError, ValueError, TypeError, KeyError):
+            # Unreadable, stale or malformed cache: rebuild it.
+            pass
+        index = cls.from_files(consensus_file, microdescs)
+        try:
+            index.save(cache_path, stamp)
+        except OSError:
+            pass
+        return index
+
+
+class ConsensusTracker:
+    """
+    Keep a RelayIndex current from NEWCONSENSUS and NS control events,
+    applying each one as a diff instead of re-parsing the consensus file.
+    Exit policies for new or re-described relays are fetched from Tor's
+    local microdescriptor cache with GETINFO md/id/. After a lost control
+    connection the tracker reconnects and resyncs from GETINFO ns/all.
+    """
+
+    def __init__(self, index, controller=None):
+        self.index = index
+        self.controller = controller
+        self.updates = 0
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        self.controller = self.controller or get_controller()
+        self.controller.add_event_listener('NEWCONSENSUS', self._on_event, background=True)
+        self.controller.add_event_listener('NS', self._on_event, background=True)
+        self._watchdog = threading.Thread(target=self._watch, name='tornet-consensus', daemon=True)
+        self._watchdog.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self.controller is not None:
+            for event in ('NEWCONSENSUS', 'NS'):
+                try:
+                    self.controller.remove_event_listener(event, self._on_event)
+                except TorControlError:
+                    pass
+
+    def _on_event(self, event_type, content):
+        _, relays = parse_consensus(content)
+        added, changed, _ = self.index.apply_entries(relays, complete=event_type == 'NEWCONSENSUS')
+        self._fill_policies(added + changed)
+        self.updates += 1
+
+    def _fill_policies(self, fingerprints):
+        for fingerprint in fingerprints:
+            relay = self.index.relays.get(fingerprint)
+            if relay is None or relay.policy is not None or not relay.flags & FLAG_BITS['Exit']:
+                continue
+            key = f'md/id/{fingerprint}'
+            try:
+                descriptor = self.controller.getinfo(key).get(key, '')
+            except TorControlError:
+                continue
+            with self.index._lock:
+                for line in descriptor.splitlines():
+                    if line.startswith('p '):
+                        relay.policy = parse_policy_summary(line[2:])
+                self.index._port_cache.clear()
+
+    def resync(self):
+        """Apply Tor's in-memory consensus (GETINFO ns/all) as one diff."""
+        content = self.controller.getinfo('ns/all').get('ns/all', '')
+        if content:
+            self._on_event('NEWCONSENSUS', content)
+
+    def _watch(self):
+        delay = 1.0
+        while not self._stop.is_set():
+            self.controller.closed.wait(1.0)
+            if self._stop.is_set() or not self.controller.closed.is_set():
+                continue
+            try:
+                self.controller.connect()
+                self.resync()
+                delay = 1.0
+            except TorControlError:
+                time.sleep(delay)
+                delay = min(delay * 2, 60.0)
+
+
+_index = None
+_index_lock = threading.Lock()
+_tracker = None
+
+
+def get_relay_index():
+    """Shared relay index for the default DataDirectory, loaded on first use."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = RelayIndex.load()
+        return _index
+
+
+def track_consensus():
+    """
+    Start applying consensus events to the shared relay index. Returns
+    the tracker, or None when the control port is unavailable.
+    """
+    global _tracker
+    if _tracker is None:
+        try:
+            _tracker = ConsensusTracker(get_relay_index()).start()
+        except TorControlError:
+            return None
+    return _tracker
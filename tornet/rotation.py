@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# NEWNYM rate-limit tracking and coalescing of concurrent rotation requests
+import time
+import threading
+from .metrics import (ROTATION_SECONDS, ROTATIONS, ROTATIONS_FAILED,
+                      ROTATIONS_NOOP, ROTATIONS_COALESCED, ROTATIONS_RETRIED)
+
+# Tor ignores NEWNYM signals sent less than this many seconds apart.
+NEWNYM_RATE_LIMIT = 10.0
+
+
+class _Batch:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Rotator:
+    """
+    Serialise rotation requests around Tor's NEWNYM rate limit.
+
+    A request made while the limit is in effect, or while a rotation is
+    already under way, joins a single batch that fires at the earliest
+    allowed moment. The first caller of a batch performs the rotation and
+    every caller in it receives the same result, so a burst of requests
+    costs one NEWNYM and one probe instead of many ignored signals that
+    would each report the unchanged exit as new.
+
+    With a guard (see DiversityGuard), an exit the guard rejects is
+    rotated away again, at the next allowed moment, up to guard.retries
+    times before the batch is answered.
+    """
+
+    def __init__(self, action, min_interval=NEWNYM_RATE_LIMIT, name='default', guard=None):
+        self.action = action
+        self.min_interval = min_interval
+        self.name = name
+        self.guard = guard
+        self.rotations = 0
+        self.coalesced = 0
+        self.last_result = None
+        self._last = None
+        self._batch = None
+        self._lock = threading.Lock()
+
+    def next_allowed(self):
+        """Monotonic time at which the next rotation may be sent."""
+        with self._lock:
+            return time.monotonic() if self._last is None else self._last + self.min_interval
+
+    def rotate(self):
+        with self._lock:
+            batch = self._batch
+            if batch is None:
+                batch = self._batch = _Batch()
+                leader = True
+            else:
+                self.coalesced += 1
+                ROTATIONS_COALESCED.inc(instance=self.name)
+                leader = False
+
+        if not leader:
+            batch.done.wait()
+        else:
+            try:
+                self._wait_turn()
+                batch.result = self._run()
+                guard = self.guard
+                attempt = 0
+                while guard is not None and batch.result is not None:
+                    reason = guard.check(batch.result)
+                    if reason is None or attempt >= guard.retries:
+                        guard.remember(batch.result)
+                        break
+                    attempt += 1
+                    guard.reject(reason)
+                    ROTATIONS_RETRIED.inc(instance=self.name, reason=reason)
+                    self._wait_turn()
+                    batch.result = self._run()
+            except Exception as e:
+                batch.error = e
+            finally:
+                with self._lock:
+                    # Requests made while this rotation ran share its result;
+                    # later ones start the next batch.
+                    self._batch = None
+                batch.done.set()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.result
+
+    def _wait_turn(self):
+        """Sleep until the rate limit allows a rotation and claim the slot."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self._last is None or now >= self._last + self.min_interval:
+                    self._last = now
+                    self.rotations += 1
+                    return
+                delay = self._last + self.min_interval - now
+            time.sleep(delay)
+
+    def _run(self):
+        start = time.monotonic()
+        result = None
+        try:
+            result = self.action()
+            return result
+        finally:
+            self._observe(result, time.monotonic() - start)
+
+    def _observe(self, result, elapsed):
+        ROTATIONS.inc(instance=self.name)
+        ROTATION_SECONDS.observe(elapsed, instance=self.name)
+        if result is None:
+            ROTATIONS_FAILED.inc(instance=self.name)
+        else:
+            if result == self.last_result:
+                ROTATIONS_NOOP.inc(instance=self.name)
+            self.last_result = result
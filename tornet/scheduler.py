@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Drift-free rotation scheduling on the monotonic clock
+import time
+import heapq
+import random
+import datetime
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _parse_range(text):
+    """'30' -> (30.0, 30.0); '30-90' -> (30.0, 90.0)."""
+    text = str(text).strip()
+    low, sep, high = text.partition('-')
+    low = float(low)
+    high = float(high) if sep else low
+    if high < low:
+        raise ValueError(f"Invalid range: {text}")
+    return low, high
+
+
+class IntervalSchedule:
+    """
+    Fire every `low` seconds, or after a random period between low and
+    high. Periods are measured from the previous planned time rather than
+    from when the job finished, so slow jobs do not push the cadence back.
+    A non-zero jitter adds a random delay on top of each planned time
+    without moving the grid itself.
+    """
+
+    def __init__(self, low, high=None, jitter=(0.0, 0.0)):
+        self.low = float(low)
+        self.high = float(high if high is not None else low)
+        self.jitter = jitter if isinstance(jitter, tuple) else _parse_range(jitter)
+        if self.low <= 0:
+            raise ValueError("Interval must be positive")
+
+    def __repr__(self):
+        period = f"{self.low:g}" if self.low == self.high else f"{self.low:g}-{self.high:g}"
+        return f"IntervalSchedule({period}s)"
+
+    def _period(self):
+        return self.low if self.low == self.high else random.uniform(self.low, self.high)
+
+    def first(self, now):
+        return now + self._period()
+
+    def next(self, previous, now):
+        nxt = previous + self._period()
+        if nxt <= now:
+            if self.low == self.high:
+                # Skip the slots we overran so the grid stays anchored.
+                missed = int((now - previous) // self.low)
+                nxt = previous + (missed + 1) * self.low
+            else:
+                nxt = now
+        return nxt
+
+    def offset(self):
+        low, high = self.jitter
+        return random.uniform(low, high) if high else 0.0
+
+
+def _parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        expr, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if expr == '*':
+            start, end = low, high
+        elif '-' in expr:
+            start, end = (int(x) for x in expr.split('-', 1))
+        else:
+            start = end = int(expr)
+            if step != 1:
+                end = high
+        if start < low or end > high or start > end:
+            raise ValueError(f"Cron field out of range: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """
+    Classic five-field cron expression ('minute hour day month weekday')
+    with '*', lists, ranges and '/step'. Times follow the local wall clock
+    and are translated to the monotonic clock when scheduled.
+    """
+
+    def __init__(self, expression, jitter=(0.0, 0.0)):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression}")
+        self.expression = expression
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        self.weekdays = {d % 7 for d in _parse_cron_field(fields[4], 0, 7)}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+        self.jitter = jitter if isinstance(jitter, tuple) else _parse_range(jitter)
+
+    def __repr__(self):
+        return f"CronSchedule({self.expression!r})"
+
+    def _day_matches(self, moment):
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_wallclock(self, after):
+        moment = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                year, month = divmod(moment.month, 12)
+                moment = moment.replace(year=moment.year + year, month=month + 1, day=1, hour=0, minute=0)
+            elif not self._day_matches(moment):
+                moment = (moment + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif moment.hour not in self.hours:
+                moment = (moment + datetime.timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression never fires: {self.expression}")
+
+    def _to_monotonic(self, not_before):
+        wall, mono = time.time(), time.monotonic()
+        after = datetime.datetime.fromtimestamp(wall + max(0.0, not_before - mono))
+        return mono + (self.next_wallclock(after).timestamp() - wall)
+
+    def first(self, now):
+        return self._to_monotonic(now)
+
+    def next(self, previous, now):
+        return self._to_monotonic(max(previous, now))
+
+    def offset(self):
+        low, high = self.jitter
+        return random.uniform(low, high) if high else 0.0
+
+
+def parse_schedule(spec, jitter=(0.0, 0.0)):
+    """
+    Build a schedule from the CLI notation: '60', '30-90' or a five-field
+    cron expression such as '*/5 * * * *'.
+    """
+    if isinstance(spec, (IntervalSchedule, CronSchedule)):
+        return spec
+    spec = str(spec).strip()
+    if len(spec.split()) == 5:
+        return CronSchedule(spec, jitter)
+    low, high = _parse_range(spec)
+    return IntervalSchedule(low, high, jitter)
+
+
+class Job:
+    """A recurring task registered with a Scheduler."""
+
+    def __init__(self, scheduler, name, schedule, func, count):
+        self.scheduler = scheduler
+        self.name = name
+        self.schedule = schedule
+        self.func = func
+        self.count = count
+        self.runs = 0
+        self.errors = 0
+        self.last_lag = 0.0
+        self.anchor = None
+        self.due = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def __repr__(self):
+        return f"Job({self.name!r}, {self.schedule!r}, runs={self.runs})"
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+
+class Scheduler:
+    """
+    Run any number of independent recurring jobs from one dispatcher
+    thread. Deadlines live on the monotonic clock, each job is executed on
+    a worker thread so a slow job never delays the others, and a job is
+    never run again while its previous run is still in progress.
+    """
+
+    def __init__(self, max_workers=32):
+        self.jobs = []
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tornet-job')
+
+    def add(self, func, schedule, count=0, name=None, jitter=(0.0, 0.0)):
+        """
+        Schedule func to run repeatedly.
+
+        :param schedule: A schedule object or '60', '30-90', '*/5 * * * *'.
+        :param count: Number of runs; 0 runs until cancelled.
+        """
+        schedule = parse_schedule(schedule, jitter)
+        job = Job(self, name or getattr(func, '__name__', 'job'), schedule, func, count)
+        with self._cond:
+            job.anchor = schedule.first(time.monotonic())
+            self._push(job)
+            self.jobs.append(job)
+            self._cond.notify()
+        return job
+
+    def _push(self, job):
+        job.due = job.anchor + job.schedule.offset()
+        heapq.heappush(self._heap, (job.due, next(self._seq), job))
+
+    def cancel(self, job):
+        with self._cond:
+            job.cancelled = True
+            job.done.set()
+            self._cond.notify()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._dispatch, name='tornet-scheduler', daemon=True)
+            self._thread.start()
+        return self
+
+    def _dispatch(self):
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due, _, job = self._heap[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                if not job.cancelled:
+                    self._executor.submit(self._run, job, due)
+
+    def _run(self, job, due):
+        job.last_lag = time.monotonic() - due
+        try:
+            job.func()
+        except Exception:
+            job.errors += 1
+        with self._cond:
+            job.runs += 1
+            if job.cancelled or self._stopped or (job.count and job.runs >= job.count):
+                job.done.set()
+            else:
+                job.anchor = job.schedule.next(job.anchor, time.monotonic())
+                self._push(job)
+            self._cond.notify()
+
+    def wait(self, timeout=None):
+        """Block until every job finished or was cancelled; True if so."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for job in list(self.jobs):
+            while not job.done.wait(0.5):
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+        return True
+
+    def stop(self, wait=False):
+        """Cancel every job; a run already in progress is allowed to finish."""
+        with self._cond:
+            self._stopped = True
+            for job in self.jobs:
+                job.cancelled = True
+                job.done.set()
+            self._heap.clear()
+            self._cond.notify_all()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Warm start: check the cached consensus and pre-seed a DataDirectory from a snapshot
+import os
+import shutil
+import datetime
+from .geoip import CACHE_DIR
+from .relays import find_data_dir, newest_consensus
+
+# Directory documents Tor can start from without downloading them again.
+# The 'state' file (entry guards) is deliberately not copied between hosts.
+SEED_FILES = ('cached-certs', 'cached-microdesc-consensus', 'cached-microdescs', 'cached-microdescs.new',
+              'cached-consensus', 'cached-descriptors', 'cached-descriptors.new')
+SEED_DIR = os.environ.get('TORNET_SEED_DIR', os.path.join(CACHE_DIR, 'seed'))
+# Tor keeps using a consensus this long after valid-until ("reasonably live").
+REASONABLY_LIVE = datetime.timedelta(hours=24)
+
+
+def consensus_freshness(data_dir=None, now=None):
+    """
+    Classify the cached consensus in data_dir:
+
+    'fresh'   - before fresh-until, Tor will not fetch a new one first
+    'valid'   - before valid-until, usable while a newer one is fetched
+    'live'    - within 24h after valid-until, still usable for bootstrap
+    'expired' - too old, Tor has to download a consensus before building circuits
+    'missing' - no cached consensus at all
+
+    When both flavours are cached, the newer one counts.
+
+    :return: (state, header times dict, path)
+    """
+    data_dir = data_dir or find_data_dir()
+    now = now or datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    times, path = newest_consensus(data_dir)
+    if 'valid-until' not in times:
+        return 'missing', times, path
+    if now < times.get('fresh-until', times['valid-until']):
+        state = 'fresh'
+    elif now < times['valid-until']:
+        state = 'valid'
+    elif now < times['valid-until'] + REASONABLY_LIVE:
+        state = 'live'
+    else:
+        state = 'expired'
+    return state, times, path
+
+
+def save_snapshot(data_dir=None, seed_dir=SEED_DIR):
+    """Copy the directory documents from a bootstrapped DataDirectory into seed_dir."""
+    data_dir = data_dir or find_data_dir()
+    os.makedirs(seed_dir, exist_ok=True)
+    copied = []
+    for name in SEED_FILES:
+        source = os.path.join(data_dir, name)
+        if os.path.exists(source):
+            shutil.copy2(source, os.path.join(seed_dir, name))
+            copied.append(name)
+    return copied
+
+
+def seed_data_dir(data_dir=None, seed_dir=SEED_DIR, now=None):
+    """
+    Pre-seed data_dir from the snapshot in seed_dir when its own consensus
+    is missing or expired and the snapshot's is newer and still usable.
+    Run this before Tor starts. Returns the list of files copied (empty if
+    nothing was done). Copied files get the DataDirectory's owner, so a Tor
+    running as its own user can still replace them after a root seed.
+    """
+    data_dir = data_dir or find_data_dir()
+    state, times, _ = consensus_freshness(data_dir, now)
+    if state not in ('missing', 'expired'):
+        return []
+    seed_state, seed_times, _ = consensus_freshness(seed_dir, now)
+    if seed_state in ('missing', 'expired'):
+        return []
+    if times.get('valid-until') and seed_times['valid-until'] <= times['valid-until']:
+        return []
+    owner = _owner(data_dir)
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir, mode=0o700, exist_ok=True)
+        _chown(data_dir, owner)
+    copied = []
+    for name in SEED_FILES:
+        source = os.path.join(seed_dir, name)
+        if os.path.exists(source):
+            target = os.path.join(data_dir, name)
+            tmp = target + '.tornet-seed'
+            shutil.copy2(source, tmp)
+            _chown(tmp, owner)
+            os.replace(tmp, target)
+            copied.append(name)
+    return copied
+
+
+def _owner(path):
+    """(uid, gid) of path, or of its nearest existing parent when it does not exist yet."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    st = os.stat(path)
+    return st.st_uid, st.st_gid
+
+
+def _chown(path, owner):
+    try:
+        os.chown(path, *owner)
+    except OSError:
+        pass
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# On-demand rotation daemon over a Unix socket and localhost HTTP
+import os
+import json
+import stat
+import time
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+DEFAULT_SOCKET_PATH = os.environ.get('TORNET_SOCKET', '/tmp/tornet.sock')
+DEFAULT_HTTP_ADDRESS = os.environ.get('TORNET_HTTP', '127.0.0.1:9052')
+# Commands that change state; over HTTP they are only accepted with POST.
+WRITE_COMMANDS = ('rotate',)
+
+
+class RotationService:
+    """
+    Command handler shared by both transports. Answers for the current IP
+    and status come from memory; only 'rotate' and an explicit refresh
+    touch the network.
+    """
+
+    def __init__(self, rotate, lookup, rotator=None):
+        self._rotate = rotate
+        self._lookup = lookup
+        self.rotator = rotator
+        self.current_ip = None
+        self.last_rotation = None
+        self.failed_rotations = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def rotate(self):
+        ip = self._rotate()
+        with self._lock:
+            if ip:
+                self.current_ip = ip
+                self.last_rotation = time.time()
+            else:
+                self.failed_rotations += 1
+        return {'ok': bool(ip), 'ip': ip}
+
+    def ip(self, refresh=False):
+        if refresh or self.current_ip is None:
+            ip = self._lookup()
+            if ip:
+                self.current_ip = ip
+        return {'ok': self.current_ip is not None, 'ip': self.current_ip}
+
+    def status(self):
+        status = {
+            'ok': True,
+            'ip': self.current_ip,
+            'uptime': round(time.time() - self.started, 3),
+            'last_rotation': self.last_rotation,
+            'failed_rotations': self.failed_rotations,
+        }
+        if self.rotator is not None:
+            status['rotations'] = self.rotator.rotations
+            status['coalesced'] = self.rotator.coalesced
+            status['next_rotation_in'] = round(max(0.0, self.rotator.next_allowed() - time.monotonic()), 3)
+            if self.rotator.guard is not None:
+                status['diversity'] = self.rotator.guard.stats()
+        return status
+
+    def handle(self, command, refresh=False):
+        command = command.strip().strip('/').lower()
+        if command == 'rotate':
+            return self.rotate()
+        if command in ('ip', 'current-ip'):
+            return self.ip(refresh)
+        if command == 'status':
+            return self.status()
+        return {'ok': False, 'error': f"unknown command: {command}"}
+
+
+class _UnixHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            words = line.decode('utf-8', 'replace').split()
+            if not words:
+                continue
+            result = self.server.service.handle(words[0], refresh='refresh' in words[1:])
+            self.wfile.write(json.dumps(result).encode('utf-8') + b"\n")
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.lstat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    def _send(self, code, result, headers=()):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _from_browser(self):
+        """
+        Web pages can reach localhost too, with a cross-site form POST or
+        through DNS rebinding. Browsers send an Origin header on those and
+        a rebound request carries a foreign Host name; local tools such as
+        curl do neither.
+        """
+        if self.headers.get('Origin') is not None:
+            return True
+        local = ('localhost', '127.0.0.1', '::1')
+        if self.server.server_address[0] not in local:
+            # Bound to a routable address on purpose; any Host name may be used.
+            return False
+        host = (self.headers.get('Host') or '').rsplit(':', 1)[0].strip('[]').lower()
+        return host not in ('',) + local
+
+    def _respond(self, method):
+        if self._from_browser():
+            self._send(403, {'ok': False, 'error': 'cross-origin requests are not allowed'})
+            return
+        url = urlsplit(self.path)
+        command = (url.path or '/').strip('/').lower()
+        if method == 'GET' and command in WRITE_COMMANDS:
+            self._send(405, {'ok': False, 'error': f"use POST for {command}"}, [('Allow', 'POST')])
+            return
+        refresh = parse_qs(url.query).get('refresh', ['0'])[0] not in ('0', '', 'false')
+        result = self.server.service.handle(command, refresh)
+        self._send(200 if result.get('ok') else (404 if 'error' in result else 503), result)
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RotationServer:
+    """Serve a RotationService on a Unix socket and/or a localhost HTTP port."""
+
+    def __init__(self, service, socket_path=DEFAULT_SOCKET_PATH, http_address=DEFAULT_HTTP_ADDRESS):
+        self.service = service
+        self.socket_path = socket_path
+        self.http_address = http_address
+        self._servers = []
+
+    def start(self):
+        if self.socket_path:
+            if _is_socket(self.socket_path):
+                # A stale socket from an earlier run; never remove anything else.
+                os.unlink(self.socket_path)
+            elif os.path.lexists(self.socket_path):
+                raise FileExistsError(f"{self.socket_path} exists and is not a socket")
+            unix = _UnixServer(self.socket_path, _UnixHandler)
+            os.chmod(self.socket_path, 0o660)
+            self._servers.append(unix)
+        if self.http_address:
+            host, _, port = self.http_address.rpartition(':')
+            http = ThreadingHTTPServer((host or '127.0.0.1', int(port)), _HTTPHandler)
+            http.daemon_threads = True
+            self.http_address = f"{http.server_address[0]}:{http.server_address[1]}"
+            self._servers.append(http)
+        for server in self._servers:
+            server.service = self.service
+            threading.Thread(target=server.serve_forever, name='tornet-serve', daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        if self.socket_path and _is_socket(self.socket_path):
+            os.unlink(self.socket_path)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Shared keep-alive HTTP sessions for probes through Tor and direct
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+TOR_SOCKS_PROXY = os.environ.get('TORNET_SOCKS_PROXY', 'socks5://127.0.0.1:9050')
+POOL_SIZE = 10
+ISOLATED_CACHE_SIZE = int(os.environ.get('TORNET_ISOLATED_SESSIONS', 256))
+
+_sessions = {}
+_isolated = OrderedDict()
+_lock = threading.Lock()
+# Mixed into every SOCKS password so identities never carry over between runs.
+_isolation_nonce = os.urandom(8).hex()
+# Bumped by drop_isolated_session() so a dropped key gets new credentials,
+# and therefore a new circuit. Only dropped keys are tracked.
+_generations = OrderedDict()
+GENERATIONS_MAX = 4096
+
+
+def tor_proxies(proxy=TOR_SOCKS_PROXY):
+    return {'http': proxy, 'https': proxy}
+
+
+def _build_session(proxy):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if proxy:
+        session.proxies.update(tor_proxies(proxy))
+    return session
+
+
+def get_session(proxy=None):
+    """
+    Return the pooled session for the given SOCKS proxy URL, or the direct
+    session when proxy is None. Sessions are created on first use.
+    """
+    with _lock:
+        session = _sessions.get(proxy)
+        if session is None:
+            session = _sessions[proxy] = _build_session(proxy)
+        return session
+
+
+def get_tor_session(proxy=TOR_SOCKS_PROXY):
+    return get_session(proxy)
+
+
+def get_direct_session():
+    return get_session(None)
+
+
+def invalidate_tor_sessions(proxy=None):
+    """
+    Drop pooled connections through Tor so the next probe opens a new
+    stream. A kept-alive connection stays on its old circuit after NEWNYM
+    and would otherwise keep reporting the previous exit.
+
+    :param proxy: Only invalidate the session for this proxy URL; all Tor
+                  sessions are dropped when omitted.
+    """
+    with _lock:
+        keys = [key for key in _sessions if key is not None and (proxy is None or key == proxy)]
+        stale = [_sessions.pop(key) for key in keys]
+    for session in stale:
+        session.close()
+
+
+def _isolated_proxy(key, proxy, generation=0):
+    username = 'tornet-' + hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:24]
+    parts = urlsplit(proxy)
+    netloc = f"{username}:{_isolation_nonce}-{generation}@{parts.hostname}:{parts.port}"
+    return urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment))
+
+
+def isolated_session(key, proxy=TOR_SOCKS_PROXY):
+    """
+    Return a requests session whose traffic uses its own Tor circuit.
+
+    Each key gets unique SOCKS credentials, and Tor's IsolateSOCKSAuth
+    (on by default for every SocksPort) keeps streams with different
+    credentials on different circuits. Sessions are cached per key; the
+    least recently used one is closed once ISOLATED_CACHE_SIZE is exceeded.
+    Global rotations through change_ip() do not touch these sessions.
+    """
+    cache_key = (proxy, key)
+    with _lock:
+        session = _isolated.get(cache_key)
+        if session is not None:
+            _isolated.move_to_end(cache_key)
+            return session
+        generation = _generations.get(cache_key, 0)
+        session = _isolated[cache_key] = _build_session(_isolated_proxy(key, proxy, generation))
+        evicted = []
+        while len(_isolated) > ISOLATED_CACHE_SIZE:
+            evicted.append(_isolated.popitem(last=False)[1])
+    for old in evicted:
+        old.close()
+    return session
+
+
+def drop_isolated_session(key, proxy=TOR_SOCKS_PROXY):
+    """Forget the session for key so its next use starts a fresh circuit."""
+    cache_key = (proxy, key)
+    with _lock:
+        session = _isolated.pop(cache_key, None)
+        _generations[cache_key] = _generations.pop(cache_key, 0) + 1
+        while len(_generations) > GENERATIONS_MAX:
+            _generations.popitem(last=False)
+    if session is not None:
+        session.close()
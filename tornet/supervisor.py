@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tornet - Automate IP address changes using Tor
+# Run Tor as a supervised child process: log watching, backoff restarts, crash-loop detection
+import re
+import pwd
+import time
+import signal
+import threading
+import subprocess
+from collections import deque
+from .metrics import TOR_RESTARTS, TOR_UP
+
+_BOOTSTRAP_RE = re.compile(r'Bootstrapped (\d+)%')
+
+
+class TorSupervisor:
+    """
+    Own a Tor process: start it, follow its log on stdout, and restart it
+    when it exits.
+
+    Restarts back off exponentially from backoff_base up to backoff_max;
+    the delay resets once a process has stayed up for stable_after
+    seconds. More than max_crashes exits within crash_window is treated as
+    a crash loop, and the next attempt waits crash_loop_delay instead.
+    ready is set when the log reports 'Bootstrapped 100%' and cleared as
+    soon as the process exits, so callers can pause work until Tor is
+    usable again. on_ready callbacks run after every successful
+    (re)start, e.g. to re-apply runtime SETCONF changes; they run on their
+    own thread, so Tor's log keeps being read, and ready is only set once
+    they have finished.
+    """
+
+    def __init__(self, torrc=None, tor_binary='tor', extra_args=(), user=None,
+                 backoff_base=1.0, backoff_max=60.0, stable_after=60.0,
+                 crash_window=300.0, max_crashes=5, crash_loop_delay=300.0,
+                 log_lines=200, on_event=None):
+        self.torrc = torrc
+        self.tor_binary = tor_binary
+        self.extra_args = list(extra_args)
+        self.user = user
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self.crash_window = crash_window
+        self.max_crashes = max_crashes
+        self.crash_loop_delay = crash_loop_delay
+        self.on_event = on_event
+        self.process = None
+        self.state = 'stopped'
+        self.restarts = 0
+        self.bootstrap = 0
+        self.last_exit = None
+        self.log = deque(maxlen=log_lines)
+        self.ready = threading.Event()
+        self._on_ready = []
+        self._crashes = deque()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def command(self):
+        command = [self.tor_binary]
+        if self.torrc:
+            command += ['-f', self.torrc]
+        # Tor must stay in the foreground and log to stdout for us to follow it.
+        command += ['--RunAsDaemon', '0', '--Log', 'notice stdout']
+        return command + self.extra_args
+
+    def add_ready_callback(self, callback):
+        self._on_ready.append(callback)
+
+    def _event(self, state, message):
+        self.state = state
+        if self.on_event:
+            try:
+                self.on_event(state, message)
+            except Exception:
+                pass
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._supervise, name='tornet-tor-supervisor', daemon=True)
+        self._thread.start()
+        return self
+
+    def wait_ready(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def reload(self):
+        """Send SIGHUP so Tor re-reads its torrc."""
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.send_signal(signal.SIGHUP)
+            return True
+        return False
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._event('stopped', 'Tor stopped')
+
+    def _launch(self):
+        self.bootstrap = 0
+        kwargs = {}
+        if self.user:
+            # Drop the group and root's supplementary groups too, not just the uid.
+            try:
+                entry = pwd.getpwnam(self.user)
+            except KeyError:
+                raise OSError(f"unknown user {self.user!r}") from None
+            kwargs = {'user': entry.pw_uid, 'group': entry.pw_gid, 'extra_groups': []}
+        self.process = subprocess.Popen(self.command(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        stdin=subprocess.DEVNULL, text=True, errors='replace', bufsize=1,
+                                        **kwargs)
+        TOR_UP.set(1)
+        self._event('starting', f"Tor started (pid {self.process.pid})")
+        return self.process
+
+    def _announce(self, process):
+        # Callbacks run before ready is set so waiters see the restored state.
+        for callback in list(self._on_ready):
+            try:
+                callback()
+            except Exception:
+                pass
+        if process is self.process and process.poll() is None:
+            self.ready.set()
+            self._event('ready', "Tor bootstrapped")
+
+    def _follow(self, process):
+        announced = False
+        for line in process.stdout:
+            line = line.rstrip()
+            self.log.append(line)
+            match = _BOOTSTRAP_RE.search(line)
+            if match:
+                self.bootstrap = int(match.group(1))
+                if self.bootstrap >= 100 and not announced:
+                    announced = True
+                    threading.Thread(target=self._announce, args=(process,),
+                                     name='tornet-tor-ready', daemon=True).start()
+            elif '[err]' in line:
+                self._event(self.state, line)
+
+    def _next_delay(self, consecutive, now):
+        while self._crashes and now - self._crashes[0] > self.crash_window:
+            self._crashes.popleft()
+        if len(self._crashes) > self.max_crashes:
+            return 'crash-loop', self.crash_loop_delay
+        return 'restarting', min(self.backoff_max, self.backoff_base * 2 ** max(0, consecutive - 1))
+
+    def _supervise(self):
+        consecutive = 0
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            try:
+                process = self._launch()
+            except (OSError, subprocess.SubprocessError) as e:
+                process = None
+                self.last_exit = str(e)
+                self._event('restarting', f"Cannot start Tor: {e}")
+            if process is not None:
+                if self._stopping.is_set():
+                    # stop() ran while this process was being launched.
+                    process.terminate()
+                self._follow(process)
+                code = process.wait()
+                self.ready.clear()
+                TOR_UP.set(0)
+                self.last_exit = code
+                if self._stopping.is_set():
+                    break
+                reason = 'signal' if code < 0 else ('error' if code else 'exit')
+                TOR_RESTARTS.inc(reason=reason)
+                self._event('restarting', f"Tor exited with status {code}")
+            now = time.monotonic()
+            consecutive = 1 if now - started >= self.stable_after else consecutive + 1
+            self._crashes.append(now)
+            state, delay = self._next_delay(consecutive, now)
+            if state == 'crash-loop':
+                tail = ' | '.join(list(self.log)[-5:])
+                self._event(state, f"Tor crashed {len(self._crashes)} times in {self.crash_window:g}s; "
+                                   f"retrying in {delay:g}s. Last log: {tail}")
+            else:
+                self._event(state, f"Restarting Tor in {delay:g}s")
+            if self._stopping.wait(delay):
+                break
+            self.restarts += 1
+
+    def status(self):
+        process = self.process
+        return {
+            'state': self.state,
+            'pid': process.pid if process is not None and process.poll() is None else None,
+            'ready': self.ready.is_set(),
+            'bootstrap': self.bootstrap,
+            'restarts': self.restarts,
+            'last_exit': self.last_exit,
+        }
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Test script for the per-country exit benchmark
+Runs the TTFB/throughput measurement and the ranking against a local HTTP
+server, with Tor's SOCKS proxy and control port replaced by stand-ins
+"""
+
+import sys
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# Add the parent directory to the path to import tornet modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornet import bench
+
+PAYLOAD = b'x' * 200000
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(PAYLOAD)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Controller:
+    """Records SETCONF calls and answers GETCONF like a Tor with --countries set."""
+
+    def __init__(self):
+        self.conf = {'ExitNodes': '{nl}', 'StrictNodes': '1'}
+        self.calls = []
+
+    def getconf(self, *keys):
+        return {key: self.conf.get(key) for key in keys}
+
+    def setconf(self, options):
+        self.calls.append(dict(options))
+        self.conf.update(options)
+
+
+def _serve():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def test_measure():
+    server, url = _serve()
+    try:
+        ttfb, rate = bench.measure(requests.Session(), url)
+    finally:
+        server.shutdown()
+    assert ttfb > 0
+    assert rate > 0
+
+
+def test_bench_and_rank():
+    server, url = _serve()
+    original = bench.isolated_session
+    bench.isolated_session = lambda key, proxy: requests.Session()
+    controller = _Controller()
+    try:
+        results = bench.bench_countries(controller, ['DE', 'us'], url, samples=2)
+    finally:
+        bench.isolated_session = original
+        server.shutdown()
+
+    assert sorted(results) == ['de', 'us']
+    for result in results.values():
+        assert result['failures'] == 0
+        assert result['ttfb'] > 0 and result['throughput'] > 0
+    # Each country was pinned in turn, then the previous settings came back.
+    assert controller.calls[0] == {'ExitNodes': '{de}', 'StrictNodes': '1'}
+    assert controller.calls[1] == {'ExitNodes': '{us}', 'StrictNodes': '1'}
+    assert controller.conf == {'ExitNodes': '{nl}', 'StrictNodes': '1'}
+
+    results['fr'] = dict(results['de'], throughput=None)
+    results['nl'] = dict(results['de'], measured_at=0)
+    ranked = bench.rank_countries(results)
+    assert set(ranked) == {'de', 'us'}
+    assert bench.score(results[ranked[0]]) >= bench.score(results[ranked[1]])
+
+
+if __name__ == "__main__":
+    test_measure()
+    test_bench_and_rank()
+    print("Benchmark tests passed")
@@ -13,10 +13,52 @@ import signal
 import platform
 import random
 import json
-from .utils import install_pip, install_requests, install_tor
+from .utils import install_pip, install_requests, install_tor, update_torrc_with_countries, format_exit_nodes, TORRC_PATH
 from .banner import print_banner
+from .control import send_newnym, get_controller, wait_until_ready, tor_ready, TorControlError
+from .session import get_tor_session, get_direct_session, invalidate_tor_sessions
+from .echo import tor_resolver, direct_resolver
+from .pool import TorPool
+from .scheduler import Scheduler
+from .rotation import Rotator
+from .balancer import SocksBalancer, POLICIES, parse_address
+from .server import RotationService, RotationServer, DEFAULT_SOCKET_PATH, DEFAULT_HTTP_ADDRESS
+from .metrics import start_metrics_server, record_exit, BOOTSTRAP_SECONDS, BOOTSTRAP_PHASE_SECONDS, IP_VERIFICATIONS
+from .seed import SEED_DIR, consensus_freshness, seed_data_dir, save_snapshot
+from .geoip import lookup_country
+from .relays import get_relay_index, track_consensus
+from .diversity import DiversityGuard
+from .circuits import CircuitPool, StickyRoutes
+from .drain import drain_streams
+from .exits import ExitSelector, CountryPlan, PLAN_STRATEGIES, measure_throughput
+from .bench import DEFAULT_BENCH_URL, bench_countries, save_results, rank_countries
+from .supervisor import TorSupervisor
 TOOL_NAME = "tornet"
 
+# 'http' asks echo services through Tor; 'control' reads the exit address
+# from the control port and only verifies over HTTP for a sample of lookups.
+IP_LOOKUP_MODE = os.environ.get('TORNET_IP_MODE', 'http')
+IP_VERIFY_RATE = float(os.environ.get('TORNET_IP_VERIFY_RATE', 0.0))
+
+_active_pool = None
+# Set by --exit-mode fast: picks and pins a bandwidth-weighted exit per rotation.
+_exit_selector = None
+THROUGHPUT_URL = os.environ.get('TORNET_THROUGHPUT_URL')
+# Set by --country-plan: picks the exit country for each rotation.
+_country_plan = None
+# Seconds a rotation waits for open streams to finish (--drain), and whether
+# streams still open at the deadline are closed (--drain-cut).
+DRAIN_DEADLINE = float(os.environ.get('TORNET_DRAIN', 0))
+DRAIN_CUT = False
+# Set by --warm-circuits: controller-side stream attachment (and --sticky-ttl routes).
+_circuit_pool = None
+# Set by --supervise: Tor runs as our child process and is restarted when it
+# exits. Rotations wait up to SUPERVISE_WAIT seconds for it to be ready.
+_supervisor = None
+SUPERVISE_WAIT = 300
+# Exit countries applied with SETCONF, re-applied after a supervised restart.
+_exit_countries = None
+
 green = "\033[92m"
 red = "\033[91m"
 white = "\033[97m"
@@ -40,6 +82,9 @@ def start_tor_service():
         os.system("sudo service tor start")
 
 def reload_tor_service():
+    if _supervisor is not None:
+        _supervisor.reload()
+        return
     # In Docker environment, send SIGHUP to the Tor process instead of using service commands
     if os.environ.get('DOCKER_ENV'):
         try:
@@ -62,25 +107,119 @@ def stop_tor_service():
     else:
         os.system("sudo service tor stop")
 
-def initialize_environment():
+def initialize_environment(start_tor=True):
     install_pip()
     install_requests()
     install_tor()
     # Skip starting Tor service if running in Docker
-    if not os.environ.get('DOCKER_ENV'):
+    if start_tor and not os.environ.get('DOCKER_ENV'):
         start_tor_service()
     print_start_message()
 
+def wait_for_tor(timeout):
+    """
+    Wait for Tor to finish bootstrapping, reporting each step and how long
+    each bootstrap phase took. Returns True when ready.
+    """
+    start = time.monotonic()
+    phases = []
+
+    def progress(percent, phase):
+        now = time.monotonic()
+        tag = phase.get('TAG') or str(percent)
+        if phases:
+            previous, since = phases[-1][0], phases[-1][1]
+            phases[-1] = (previous, since, now - since)
+            BOOTSTRAP_PHASE_SECONDS.observe(now - since, phase=previous)
+        phases.append((tag, now, None))
+        summary = phase.get('SUMMARY') or tag
+        print(f"{white} [{cyan}*{white}]{cyan} Bootstrapped {white}{percent}%{cyan}: {summary}{reset}")
+
+    print(f"{white} [{cyan}*{white}]{cyan} Waiting up to {white}{timeout:g}s{cyan} for Tor to bootstrap...{reset}")
+    if wait_until_ready(timeout, progress):
+        elapsed = time.monotonic() - start
+        BOOTSTRAP_SECONDS.observe(elapsed, instance='default')
+        print(f"{white} [{green}+{white}]{green} Tor is ready after {white}{elapsed:.1f}s{reset}")
+        for tag, _, duration in phases:
+            if duration is not None:
+                print(f"{white}   {tag:<28}{green}{duration:7.2f}s{reset}")
+        return True
+    print(f"{white} [{red}!{white}] {red}Tor did not finish bootstrapping within {timeout:g}s.{reset}")
+    return False
+
+def check_consensus(seed=True):
+    """
+    Report how fresh Tor's cached consensus is and, when it is missing or
+    expired, pre-seed the DataDirectory from the snapshot in SEED_DIR.
+    Only useful before Tor starts; Tor reads these files at startup.
+    """
+    state, times, path = consensus_freshness()
+    until = times.get('valid-until')
+    detail = f" (valid until {until:%Y-%m-%d %H:%M} UTC)" if until else ''
+    color = green if state in ('fresh', 'valid', 'live') else red
+    print(f"{white} [{color}{'+' if color == green else '!'}{white}]{color} Cached consensus: {white}{state}{color}{detail}{reset}")
+    if seed and state in ('missing', 'expired'):
+        try:
+            copied = seed_data_dir()
+        except OSError as e:
+            print(f"{white} [{red}!{white}] {red}Could not seed the DataDirectory: {e}{reset}")
+            return state
+        if copied:
+            print(f"{white} [{green}+{white}]{green} Seeded the DataDirectory from {white}{SEED_DIR}{green}: {', '.join(copied)}{reset}")
+            state = consensus_freshness()[0]
+        else:
+            print(f"{white} [{red}!{white}] {red}No newer snapshot in {SEED_DIR}; Tor will download the consensus.{reset}")
+    return state
+
 def print_start_message():
-    print(f"{white} [{green}+{white}]{green} Tor service started. Please wait a minute for Tor to connect.")
+    print(f"{white} [{green}+{white}]{green} Tor service started. Use --wait-ready to wait until it has finished connecting.")
     print(f"{white} [{green}+{white}]{green} Make sure to configure your browser to use Tor for anonymity.")
 
-def ma_ip():
+def ma_ip(mode=None, verify_rate=None):
+    mode = mode or IP_LOOKUP_MODE
+    verify_rate = IP_VERIFY_RATE if verify_rate is None else verify_rate
     if is_tor_running():
+        if mode == 'control':
+            ip = ma_ip_control()
+            if ip and random.random() >= verify_rate:
+                return ip
+            if ip:
+                return verify_control_ip(ip)
         return ma_ip_tor()
     else:
         return ma_ip_normal()
 
+def verify_control_ip(ip):
+    """
+    Check a control-port answer against an echo service. The control port
+    only guesses which circuit carries new streams, so the HTTP answer wins
+    and disagreements are counted in tornet_ip_verifications_total.
+    """
+    observed = ma_ip_tor()
+    if not observed:
+        return ip
+    if observed == ip:
+        IP_VERIFICATIONS.inc(result='match')
+    else:
+        IP_VERIFICATIONS.inc(result='mismatch')
+        print(f"{white} [{red}!{white}] {red}Control port reported exit {white}{ip}{red} but the echo service saw {white}{observed}{reset}")
+    return observed
+
+def ma_ip_control():
+    """
+    Find the exit IP without any outbound request: take the exit relay of
+    the active circuit from the control port and look its address up in
+    Tor's cached consensus. Returns None so callers can fall back to HTTP.
+    """
+    try:
+        controller = get_controller()
+        fingerprint = _circuit_pool.exit_fingerprint() if _circuit_pool is not None else None
+        if fingerprint:
+            return controller.relay_address(fingerprint)
+        return controller.exit_address()
+    except TorControlError:
+        return None
+
 def is_tor_running():
     try:
         subprocess.check_output('pgrep -x tor', shell=True)
@@ -89,66 +228,252 @@ def is_tor_running():
         return False
 
 def ma_ip_tor():
-    url = 'https://api.ipify.org'
-    proxies = {
-        'http': 'socks5://127.0.0.1:9050',
-        'https': 'socks5://127.0.0.1:9050'
-    }
-    try:
-        response = requests.get(url, proxies=proxies)
-        response.raise_for_status()
-        return response.text.strip()
-    except requests.RequestException:
+    ip, _ = tor_resolver.lookup()
+    if not ip:
         print(f'{white} [{red}!{white}] {red}Having trouble connecting to the Tor network. wait a minute.{reset}')
-        return None
+    return ip
 
 def ma_ip_normal():
-    try:
-        response = requests.get('https://api.ipify.org')
-        response.raise_for_status()
-        return response.text.strip()
-    except requests.RequestException:
+    ip, _ = direct_resolver.lookup()
+    if not ip:
         print(f'{white} [{red}!{white}] {red}Having trouble fetching the IP address. Please check your internet connection.{reset}')
+    return ip
+
+def _rotate_identity():
+    # Rotations are held back while a supervised Tor is restarting.
+    if _supervisor is not None and not _supervisor.wait_ready(SUPERVISE_WAIT):
+        print(f"{white} [{red}!{white}] {red}Tor is not ready ({_supervisor.state}); skipping this rotation.{reset}")
         return None
+    if DRAIN_DEADLINE > 0:
+        # Close our own kept-alive probe connections first so the drain
+        # does not wait on (or cut) them.
+        invalidate_tor_sessions()
+        drain_before_rotation()
+    country = _country_plan.next() if _country_plan is not None else None
+    relay = None
+    # A warm spare circuit changes identity without NEWNYM or a circuit build.
+    if _circuit_pool is None or _circuit_pool.rotate(country) is None:
+        live = True
+        if _exit_selector is not None:
+            relay = pin_fast_exit(country)
+        elif country:
+            live = set_exit_countries([country], reload=False)
+        # Prefer SIGNAL NEWNYM over the control port; fall back to a full reload
+        # when the control port is disabled or authentication fails. A
+        # country written to the torrc needs that reload anyway, once.
+        if not live or not send_newnym():
+            reload_tor_service()
+    invalidate_tor_sessions()
+    ip = ma_ip()
+    if ip:
+        record_exit(ip, exit_country(ip))
+        if relay is not None and THROUGHPUT_URL:
+            rate = measure_throughput(get_tor_session(), THROUGHPUT_URL)
+            if rate:
+                _exit_selector.record_throughput(relay.fingerprint, rate)
+    return ip
+
+def drain_before_rotation():
+    """Give streams open on the current identity until DRAIN_DEADLINE to finish."""
+    try:
+        result = drain_streams(get_controller(), DRAIN_DEADLINE, cut=DRAIN_CUT)
+    except TorControlError:
+        return None
+    if result:
+        print(f"{white} [{cyan}*{white}]{cyan} Streams before rotation: {white}{result.drained}{cyan} drained, "
+              f"{white}{result.cut}{cyan} cut, {white}{result.carried}{cyan} left on the previous circuit "
+              f"({result.waited:.1f}s){reset}")
+    return result
+
+def pin_fast_exit(country=None):
+    """Pick a bandwidth-weighted exit and pin it with SETCONF ExitNodes."""
+    countries = [country] if country else None
+    relay = _exit_selector.choose(countries=countries)
+    if relay is None:
+        reason = _exit_selector.why_empty(countries)
+        print(f"{white} [{red}!{white}] {red}Cannot pick a fast exit: {reason}; keeping the current exit settings.{reset}")
+        return None
+    try:
+        return _exit_selector.pin(get_controller(), relay)
+    except TorControlError as e:
+        print(f"{white} [{red}!{white}] {red}Could not pin exit {relay.nickname}: {e}{reset}")
+        return None
+
+def exit_country(ip):
+    """Country of an exit from the local GeoIP files, then the control port."""
+    country = lookup_country(ip)
+    if country:
+        return country
+    try:
+        return get_controller().ip_country(ip)
+    except TorControlError:
+        return None
+
+_rotator = Rotator(_rotate_identity)
 
 def change_ip():
-    reload_tor_service()
-    return ma_ip()
+    """
+    Rotate to a new identity and return the new IP. Calls that arrive
+    within Tor's NEWNYM rate-limit window share a single rotation.
+    """
+    return _rotator.rotate()
 
-def change_ip_repeatedly(interval, count):
-    if isinstance(interval, int):
-        interval = str(interval)  # Convert integer to string for consistency
+def change_ip_repeatedly(interval, count, jitter=0):
+    """
+    Rotate on a drift-free schedule.
 
-    if count == 0:  # null
-        while True:
-            try:
-                inte = interval.split("-")
-                time.sleep(random.randint(int(inte[0]), int(inte[1])))
-                new_ip = change_ip()
-                if new_ip:
-                    print_ip(new_ip)
-            except IndexError:
-                time.sleep(int(interval))
-                new_ip = change_ip()
-                if new_ip:
-                    print_ip(new_ip)
-    else:
-        for _ in range(count):
-            try:
-                inte = interval.split("-")
-                time.sleep(random.randint(int(inte[0]), int(inte[1])))
-                new_ip = change_ip()
-                if new_ip:
-                    print_ip(new_ip)
-            except IndexError:
-                time.sleep(int(interval))
-                new_ip = change_ip()
-                if new_ip:
-                    print_ip(new_ip)
+    :param interval: Seconds ('60'), a random range ('30-90') or a cron
+                     expression ('*/5 * * * *').
+    :param count: Number of rotations; 0 rotates until interrupted.
+    :param jitter: Extra random delay per rotation, in seconds or 'min-max'.
+    """
+    def rotate():
+        new_ip = change_ip()
+        if new_ip:
+            print_ip(new_ip)
+
+    scheduler = Scheduler().start()
+    scheduler.add(rotate, interval, count=count, name='rotate', jitter=jitter)
+    try:
+        scheduler.wait()
+    finally:
+        scheduler.stop()
 
 def print_ip(ip):
     print(f'{white} [{green}+{white}]{green} Your IP has been changed to {white}:{green} {ip}')
 
+def print_pool_ip(instance, ip):
+    if ip:
+        print(f'{white} [{green}+{white}]{green} Instance {instance.index} ({instance.socks_port}) IP changed to {white}:{green} {ip}')
+    else:
+        print(f'{white} [{red}!{white}] {red}Instance {instance.index} ({instance.socks_port}) could not confirm its new IP.{reset}')
+
+def run_pool(size, interval, count, countries=None, listen=None, policy='round-robin', jitter=0, country_plan=None,
+             guard=None):
+    """
+    Start a pool of independent Tor instances and rotate each of them on
+    its own schedule until count rotations are done (0 = forever). With
+    listen set, a single SOCKS5 front proxy spreads clients over the pool.
+    A country_plan is shared by all instances, so consecutive rotations
+    anywhere in the pool move through its countries; so is a diversity
+    guard, so no two instances settle on the same exit or subnet.
+    """
+    global _active_pool
+    _active_pool = TorPool(size, countries=countries, country_plan=country_plan, guard=guard)
+    balancer = None
+    try:
+        try:
+            ready = _active_pool.start()
+        except OSError as e:
+            print(f"{white} [{red}!{white}] {red}{e}{reset}")
+            return
+        for instance in _active_pool.instances:
+            state = f"{green}ready" if instance in ready else f"{red}not responding"
+            print(f"{white} [{green}+{white}]{green} Instance {instance.index}: SOCKS {white}127.0.0.1:{instance.socks_port}{green}, control {white}127.0.0.1:{instance.control_port}{green} - {state}{reset}")
+        if listen:
+            host, port = parse_address(listen)
+            balancer = SocksBalancer.from_pool(_active_pool, host=host, port=port, policy=policy).start_in_thread()
+            print(f"{white} [{green}+{white}]{green} Load-balancing SOCKS5 proxy ({policy}) listening on {white}{host}:{balancer.port}{reset}")
+        _active_pool.run(interval, count, on_rotate=print_pool_ip, jitter=jitter)
+    finally:
+        if balancer is not None:
+            balancer.stop()
+        _active_pool.stop()
+        _active_pool = None
+
+def serve(socket_path=DEFAULT_SOCKET_PATH, http_address=DEFAULT_HTTP_ADDRESS):
+    """
+    Run as a daemon that rotates on request instead of on a timer.
+    Accepts 'rotate', 'ip' and 'status' on a Unix socket and over HTTP.
+    """
+    service = RotationService(change_ip, ma_ip, _rotator)
+    try:
+        server = RotationServer(service, socket_path or None, http_address or None).start()
+    except OSError as e:
+        print(f"{white} [{red}!{white}] {red}Cannot start the rotation server: {e}{reset}")
+        return
+    if server.socket_path:
+        print(f"{white} [{green}+{white}]{green} Listening on Unix socket {white}{server.socket_path}{reset}")
+    if server.http_address:
+        print(f"{white} [{green}+{white}]{green} Listening on {white}http://{server.http_address}{green} (/rotate, /ip, /status){reset}")
+    try:
+        while True:
+            time.sleep(3600)
+    finally:
+        server.stop()
+
+def list_exit_countries(port=None):
+    """Print exit countries from the cached consensus, largest bandwidth first."""
+    summary = get_relay_index().country_summary(port=port)
+    if not summary:
+        print(f"{white} [{red}!{white}] {red}No cached consensus found. Set TORNET_DATA_DIR to Tor's DataDirectory.{reset}")
+        return summary
+    print(f"{white} [{cyan}*{white}]{cyan} Exit countries in the cached consensus{f' allowing port {port}' if port else ''}:{reset}")
+    for country, (count, bandwidth) in sorted(summary.items(), key=lambda item: -item[1][1]):
+        print(f"{white}   {(country or '??').upper():<4}{green}{count:>5} exits {white}{bandwidth / 1000:>10.1f} MB/s{reset}")
+    return summary
+
+def bench(countries=None, url=DEFAULT_BENCH_URL, samples=3):
+    """
+    Measure TTFB and throughput through exits in each country and store the
+    results; later runs without --countries pick from the best ones.
+    """
+    if not countries:
+        summary = get_relay_index().country_summary(port=443)
+        countries = [cc for cc, _ in sorted(summary.items(), key=lambda item: -item[1][1]) if cc][:10]
+    countries = countries or ['us', 'de', 'fr', 'nl', 'ca']
+    try:
+        controller = get_controller()
+    except (OSError, TorControlError) as e:
+        print(f"{white} [{red}!{white}] {red}Benchmarking needs the control port: {e}{reset}")
+        return {}
+    print(f"{white} [{cyan}*{white}]{cyan} Benchmarking {len(countries)} countries against {white}{url}{reset}")
+
+    def report(country, result):
+        if result['ttfb'] is None:
+            print(f"{white}   {country.upper():<4}{red}all {result['samples']} samples failed{reset}")
+        else:
+            print(f"{white}   {country.upper():<4}{green}TTFB {white}{result['ttfb']:6.2f}s  "
+                  f"{green}throughput {white}{result['throughput']:9.1f} kB/s  "
+                  f"{green}failures {white}{result['failures']}/{result['samples']}{reset}")
+
+    try:
+        results = bench_countries(controller, countries, url, samples, on_result=report)
+    except TorControlError as e:
+        print(f"{white} [{red}!{white}] {red}Benchmark aborted, could not set or restore ExitNodes: {e}{reset}")
+        exit(1)
+    ranking = rank_countries(save_results(results))
+    print(f"{white} [{green}+{white}]{green} Ranking: {white}{','.join(ranking) or 'none'}{reset}")
+    return results
+
+def build_country_plan(spec, strategy):
+    """A CountryPlan over the countries in spec that have usable exits."""
+    plan = CountryPlan.parse(spec, strategy)
+    usable = filter_countries_with_exits(plan.countries)
+    pairs = [(cc, w) for cc, w in zip(plan.countries, plan.weights) if cc in usable]
+    plan = CountryPlan([cc for cc, _ in pairs], strategy, [w for _, w in pairs])
+    print(f"{white} [{green}+{white}]{green} Country plan ({strategy}): {white}{','.join(plan.countries)}{reset}")
+    return plan
+
+def default_countries(predefined, top=3):
+    """The best benchmarked countries, or the predefined list if none are stored."""
+    ranked = [cc for cc in rank_countries() if cc]
+    return ranked[:top] or predefined
+
+def filter_countries_with_exits(countries):
+    """
+    Drop countries without usable exits in the cached consensus. The list
+    is returned unchanged when no consensus is available.
+    """
+    index = get_relay_index()
+    if not len(index):
+        return countries
+    usable = [cc for cc in countries if index.exits(country=cc)]
+    for cc in countries:
+        if cc not in usable:
+            print(f"{white} [{red}!{white}] {red}No usable exit relays in country '{cc}' in the current consensus.{reset}")
+    return usable or countries
+
 def auto_fix():
     install_pip()
     install_requests()
@@ -156,6 +481,7 @@ def auto_fix():
     os.system("pip3 install --upgrade tornet")
 
 def stop_services():
+    reset_stream_attachment()
     # In Docker environment, find and kill the Tor process directly
     if os.environ.get('DOCKER_ENV'):
         try:
@@ -173,30 +499,117 @@ def stop_services():
     os.system(f"pkill -f {TOOL_NAME} > /dev/null 2>&1")
     print(f"{white} [{green}+{white}]{green} Tor services and {TOOL_NAME} processes stopped.{reset}")
 
+def reset_stream_attachment():
+    """
+    Hand stream attachment back to Tor in case an earlier run with
+    --warm-circuits was killed before it could; every new stream on that
+    Tor would wait for a controller otherwise.
+    """
+    try:
+        get_controller().setconf({'__LeaveStreamsUnattached': None})
+    except TorControlError:
+        pass
+
+def stop_circuit_pool():
+    """Hand stream attachment back to Tor; it stays with the controller otherwise."""
+    global _circuit_pool
+    if _circuit_pool is not None:
+        _circuit_pool.stop()
+        _circuit_pool = None
+
+def start_supervised_tor(user=None):
+    """
+    Run Tor as a child process that is restarted with backoff when it
+    exits, instead of relying on the system service manager.
+    """
+    global _supervisor
+    if is_tor_running():
+        print(f"{white} [{red}!{white}] {red}Tor is already running; stop it before using --supervise.{reset}")
+        return None
+
+    def report(state, message):
+        if state in ('starting', 'ready'):
+            print(f"{white} [{green}+{white}]{green} {message}{reset}")
+        else:
+            print(f"{white} [{red}!{white}] {red}{message}{reset}")
+
+    _supervisor = TorSupervisor(TORRC_PATH, user=user, on_event=report)
+    _supervisor.add_ready_callback(restore_runtime_state)
+    # Make `tornet --stop` and container shutdowns take the child down with us.
+    signal.signal(signal.SIGTERM, signal_handler)
+    return _supervisor.start()
+
+def restore_runtime_state():
+    """
+    SETCONF changes and circuits die with the Tor process; put them back
+    after a supervised restart: the pinned fast exit, the country plan's
+    current country or the fixed exit countries.
+    """
+    if _supervisor is None or not _supervisor.restarts:
+        return
+    if _exit_selector is not None and _exit_selector.current is not None:
+        try:
+            _exit_selector.pin(get_controller(), _exit_selector.current)
+        except TorControlError as e:
+            print(f"{white} [{red}!{white}] {red}Could not pin exit {_exit_selector.current.nickname} again: {e}{reset}")
+    elif _country_plan is not None and _country_plan.current:
+        set_exit_countries([_country_plan.current])
+    elif _exit_countries:
+        set_exit_countries(_exit_countries)
+    if _circuit_pool is not None:
+        try:
+            get_controller()
+            _circuit_pool.reset()
+        except TorControlError as e:
+            print(f"{white} [{red}!{white}] {red}Could not restore warm circuits: {e}{reset}")
+
+def stop_supervised_tor():
+    global _supervisor
+    if _supervisor is not None:
+        _supervisor.stop()
+        _supervisor = None
+
 def signal_handler(sig, frame):
-    stop_services()
+    stop_circuit_pool()
+    if _active_pool is not None:
+        _active_pool.stop()
+        print(f"{white} [{green}+{white}]{green} Tor pool instances stopped.{reset}")
+    elif _supervisor is not None:
+        stop_supervised_tor()
+    else:
+        stop_services()
     print(f"\n{white} [{red}!{white}] {red}Program terminated by user.{reset}")
     exit(0)
 
 def check_internet_connection():
     """Check internet connection once, don't block execution"""
     try:
-        response = requests.get('https://api.ipify.org', timeout=5)
+        response = get_direct_session().get('https://api.ipify.org', timeout=5)
         return True
     except requests.RequestException:
         print(f"{white} [{red}!{white}] {red}Internet connection issue. Some features may not work properly.{reset}")
         return False
 
-def update_torrc_with_countries(countries):
-    torrc_path = "/etc/tor/torrc"
+def set_exit_countries(countries, persist=False, reload=True):
+    """
+    Restrict exits to countries on the running Tor with SETCONF. The torrc
+    is only written when persist is set, or when the control port cannot
+    be used and a reload is the only way to apply the change; pass
+    reload=False when the caller reloads Tor itself. Returns whether the
+    change was applied live.
+    """
+    exit_nodes = format_exit_nodes(countries)
+    live = False
     try:
-        with open(torrc_path, "a") as torrc:
-            torrc.write("\n# Tornet dynamic configuration\n")
-            torrc.write("ExitNodes " + ",".join(countries) + "\n")
-            torrc.write("StrictNodes 1\n")
-        print(f"{white} [{green}+{white}]{green} Tor configuration updated with countries: {white}{','.join(countries)}{reset}")
-    except Exception as e:
-        print(f"{white} [{red}!{white}] {red}Error updating Tor configuration: {str(e)}{reset}")
+        get_controller().setconf({'ExitNodes': exit_nodes or None, 'StrictNodes': '1' if exit_nodes else None})
+        live = True
+        print(f"{white} [{green}+{white}]{green} Exit countries set to {white}{exit_nodes or 'any'}{reset}")
+    except TorControlError as e:
+        print(f"{white} [{red}!{white}] {red}Control port unavailable ({e}); writing the setting to torrc instead.{reset}")
+    if persist or not live:
+        if update_torrc_with_countries(countries) and not live and reload:
+            reload_tor_service()
+    return live
 
 def check_dns_leaks():
     """
@@ -212,10 +625,7 @@ def check_dns_leaks():
         'https://api.ipify.org?format=json' # Ipify
     ]
     
-    proxies = {
-        'http': 'socks5://127.0.0.1:9050',
-        'https': 'socks5://127.0.0.1:9050'
-    }
+    tor_session = get_tor_session()
     
     tor_dns_servers = []
     direct_dns_servers = []
@@ -225,7 +635,7 @@ def check_dns_leaks():
         print(f"{white} [{cyan}*{white}]{cyan} Testing DNS resolution through Tor...{reset}")
         for url in dns_test_urls[:2]:  # Test first 2 URLs
             try:
-                response = requests.get(url, proxies=proxies, timeout=10)
+                response = tor_session.get(url, timeout=10)
                 if response.status_code == 200:
                     if 'cloudflare' in url:
                         # Parse Cloudflare trace
@@ -246,7 +656,7 @@ def check_dns_leaks():
         # Test direct connection (without Tor) for comparison
         print(f"{white} [{cyan}*{white}]{cyan} Testing DNS resolution without Tor...{reset}")
         try:
-            response = requests.get('https://ipinfo.io/json', timeout=5)
+            response = get_direct_session().get('https://ipinfo.io/json', timeout=5)
             if response.status_code == 200:
                 data = response.json()
                 if 'org' in data:
@@ -298,10 +708,12 @@ def check_ip_info(ip=None):
     
     print(f"{white} [{cyan}*{white}]{cyan} Getting detailed information for IP: {white}{ip}{reset}")
     
-    proxies = {
-        'http': 'socks5://127.0.0.1:9050',
-        'https': 'socks5://127.0.0.1:9050'
-    } if is_tor_running() else None
+    # Country comes from Tor's GeoIP files; the services below only add org/ASN details.
+    country = lookup_country(ip)
+    if country:
+        print(f"{white} [{cyan}*{white}]{cyan} Country (offline GeoIP): {white}{country.upper()}{reset}")
+    
+    session = get_tor_session() if is_tor_running() else get_direct_session()
     
     try:
         # Try multiple IP info services
@@ -314,7 +726,7 @@ def check_ip_info(ip=None):
         for service_url, params in services:
             try:
                 url = f"{service_url}?fields={params}" if params else service_url
-                response = requests.get(url, proxies=proxies, timeout=10)
+                response = session.get(url, timeout=10)
                 
                 if response.status_code == 200:
                     data = response.json()
@@ -415,11 +827,14 @@ def check_tor_circuit_status():
         return False
 
 def main():
+    global IP_LOOKUP_MODE, IP_VERIFY_RATE, DRAIN_DEADLINE, DRAIN_CUT, THROUGHPUT_URL, SUPERVISE_WAIT, _exit_selector, _country_plan, _circuit_pool, _exit_countries
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGQUIT, signal_handler)
 
     parser = argparse.ArgumentParser(description="TorNet - Automate IP address changes using Tor")
-    parser.add_argument('--interval', type=str, default=60, help='Time in seconds between IP changes')
+    parser.add_argument('command', nargs='?', choices=['serve', 'bench-countries', 'ready', 'seed'], help='seed: check the cached consensus and pre-seed the DataDirectory from a snapshot if it is missing or expired (run before Tor starts); serve: run as a daemon that rotates on request over a Unix socket and HTTP; bench-countries: measure exits per country and store a ranking; ready: exit 0 if Tor is bootstrapped with a working circuit, 1 otherwise')
+    parser.add_argument('--interval', type=str, default=60, help='Time in seconds between IP changes, a random range (30-90) or a cron expression ("*/5 * * * *")')
+    parser.add_argument('--jitter', type=str, default='0', help='Extra random delay added to each rotation, in seconds or as a range (e.g. 0-10)')
     parser.add_argument('--count', type=int, default=10, help='Number of times to change the IP. If 0, change IP indefinitely')
     parser.add_argument('--ip', action='store_true', help='Display the current IP address and exit')
     parser.add_argument('--auto-fix', action='store_true', help='Automatically fix issues (install/upgrade packages)')
@@ -428,8 +843,51 @@ def main():
     parser.add_argument('--dns-leak-test', action='store_true', help='Perform DNS leak detection test and exit')
     parser.add_argument('--ip-info', action='store_true', help='Show detailed information about current IP and exit')
     parser.add_argument('--security-check', action='store_true', help='Perform comprehensive security check and exit')
+    parser.add_argument('--country-plan', choices=PLAN_STRATEGIES, help='Switch exit country on every rotation: round-robin, weighted (--countries us:3,de:1) or random without repeats')
+    parser.add_argument('--diversity', type=int, default=0, help='Re-rotate when the new exit matches one of the last N exits, their /24 or /16, or (with TORNET_ASN_DB) their AS')
+    parser.add_argument('--diversity-retries', type=int, default=3, help='Extra rotations allowed per request to find a diverse exit')
+    parser.add_argument('--warm-circuits', type=int, default=0, help='Keep N pre-built circuits (per --country-plan country) and rotate by switching new streams onto one of them. Tor holds new streams for tornet while this runs; if tornet is killed, run "tornet --stop" or start it again to release them')
+    parser.add_argument('--sticky-ttl', type=float, default=0, help='Keep each destination host on its circuit across rotations until it has been idle this many seconds (requires --warm-circuits)')
+    parser.add_argument('--sticky-hosts', type=int, default=1024, help='Most destination hosts remembered for --sticky-ttl (least recently used are evicted)')
+    parser.add_argument('--drain', type=float, default=DRAIN_DEADLINE, help='Before each rotation, wait up to this many seconds for open streams to finish')
+    parser.add_argument('--drain-cut', action='store_true', help='Close streams still open when the --drain deadline passes instead of leaving them on the old circuit')
+    parser.add_argument('--wait-ready', type=float, nargs='?', const=300, default=0, help='Wait up to this many seconds (default 300) for Tor to finish bootstrapping before rotating; with "ready", wait instead of failing immediately')
+    parser.add_argument('--supervise', action='store_true', help='Run Tor as a child process and restart it with backoff when it exits, instead of using the system service')
+    parser.add_argument('--tor-user', type=str, default=os.environ.get('TORNET_TOR_USER'), help='With --supervise, run Tor as this user (e.g. debian-tor)')
+    parser.add_argument('--save-seed', action='store_true', help='With "seed", save the current DataDirectory documents as the snapshot instead')
+    parser.add_argument('--persist-countries', action='store_true', help='Also save the exit countries to a managed torrc include so they survive a Tor restart')
+    parser.add_argument('--exit-mode', choices=['country', 'fast'], default='country', help='country: let Tor pick exits in --countries; fast: pin a bandwidth-weighted exit on every rotation')
+    parser.add_argument('--min-bandwidth', type=int, default=0, help='In fast exit mode, skip exits advertising less consensus bandwidth than this (kB/s)')
+    parser.add_argument('--throughput-url', type=str, default=THROUGHPUT_URL, help='In fast exit mode, download this URL after each rotation and weight exits by measured throughput')
+    parser.add_argument('--list-countries', action='store_true', help='List exit countries in the cached consensus with exit counts and bandwidth, then exit')
+    parser.add_argument('--bench-url', type=str, default=DEFAULT_BENCH_URL, help='URL downloaded by bench-countries to measure TTFB and throughput')
+    parser.add_argument('--bench-samples', type=int, default=3, help='Fresh circuits measured per country by bench-countries')
+    parser.add_argument('--ip-mode', choices=['http', 'control'], default=IP_LOOKUP_MODE, help='How to discover the exit IP: echo services over HTTP, or the control port and cached consensus')
+    parser.add_argument('--verify-rate', type=float, default=IP_VERIFY_RATE, help='Fraction of control-port lookups to double-check over HTTP (0-1)')
+    parser.add_argument('--instances', type=int, default=1, help='Run N independent Tor instances, each with its own SOCKS and control port')
+    parser.add_argument('--listen', type=str, help='With --instances, serve one load-balancing SOCKS5 proxy on [HOST:]PORT')
+    parser.add_argument('--balance-policy', choices=POLICIES, default='round-robin', help='How the --listen proxy picks a Tor instance for each connection')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET_PATH, help='Unix socket path for serve mode (empty to disable)')
+    parser.add_argument('--http', type=str, default=DEFAULT_HTTP_ADDRESS, help='[HOST:]PORT for the serve mode HTTP endpoint (empty to disable)')
+    parser.add_argument('--metrics', type=str, help='Serve Prometheus metrics on [HOST:]PORT (e.g. 127.0.0.1:9153)')
     parser.add_argument('--version', action='version', version='%(prog)s 2.2.0')
     args = parser.parse_args()
+    if args.countries and ':' in args.countries and not args.country_plan:
+        parser.error('country weights such as us:3 need --country-plan weighted')
+    if args.sticky_ttl > 0 and args.warm_circuits <= 0:
+        # Without the pool every rotation is a NEWNYM, and Tor closes the
+        # idle circuits the routes point at.
+        parser.error('--sticky-ttl requires --warm-circuits')
+
+    IP_LOOKUP_MODE = args.ip_mode
+    IP_VERIFY_RATE = args.verify_rate
+    DRAIN_DEADLINE = args.drain
+    DRAIN_CUT = args.drain_cut
+
+    if args.metrics:
+        metrics_server = start_metrics_server(args.metrics)
+        host, port = metrics_server.server_address[:2]
+        print(f"{white} [{green}+{white}]{green} Metrics available at {white}http://{host}:{port}/metrics{reset}")
 
     if args.ip:
         ip = ma_ip()
@@ -448,6 +906,27 @@ def main():
         check_ip_info()
         return
 
+    if args.list_countries:
+        list_exit_countries()
+        return
+
+    if args.command == 'ready':
+        ready = wait_until_ready(args.wait_ready) if args.wait_ready else tor_ready()
+        print("ready" if ready else "not ready")
+        exit(0 if ready else 1)
+
+    if args.command == 'seed':
+        if args.save_seed:
+            copied = save_snapshot()
+            print(f"{white} [{green}+{white}]{green} Saved {white}{', '.join(copied) or 'nothing'}{green} to {white}{SEED_DIR}{reset}")
+        else:
+            check_consensus()
+        return
+
+    if args.command == 'bench-countries':
+        bench(args.countries.split(',') if args.countries else None, args.bench_url, args.bench_samples)
+        return
+
     if args.security_check:
         if not is_tor_installed():
             print(f"{white} [{red}!{white}] {red}Tor is not installed. Please install Tor first.{reset}")
@@ -468,21 +947,84 @@ def main():
         stop_services()
         return
 
-    # Randomly select a country if no countries are provided
-    predefined_countries = ['us', 'de', 'fr', 'nl', 'ca']
-    if not args.countries:
-        selected_country = random.choice(predefined_countries)
-        update_torrc_with_countries([selected_country])
-        print(f"Randomly selected country: {selected_country}")
-    else:
-        countries = args.countries.split(',')
-        update_torrc_with_countries(countries)
+    # Randomly select a country if no countries are provided, preferring
+    # the best countries from the last bench-countries run.
+    predefined_countries = default_countries(['us', 'de', 'fr', 'nl', 'ca'])
+    if args.country_plan:
+        _country_plan = build_country_plan(args.countries or ','.join(predefined_countries), args.country_plan)
 
-    reload_tor_service()
+    guard = None
+    if args.diversity > 0:
+        guard = DiversityGuard.from_env(size=args.diversity, retries=args.diversity_retries)
+        _rotator.guard = guard
+        asn_note = f", {len(guard.asn_table)} ASN ranges" if guard.asn_table is not None else ''
+        print(f"{white} [{green}+{white}]{green} Exit diversity: last {white}{args.diversity}{green} exits, /24 and /16{asn_note}, up to {white}{args.diversity_retries}{green} retries{reset}")
+
+    if args.instances > 1:
+        print_banner()
+        run_pool(args.instances, args.interval, args.count,
+                 args.countries.split(',') if args.countries and not _country_plan else None,
+                 listen=args.listen, policy=args.balance_policy, jitter=args.jitter, country_plan=_country_plan,
+                 guard=guard)
+        return
+
+    # With a country plan, each rotation sets its own country live.
+    countries = None
+    if args.exit_mode == 'fast':
+        # ExitNodes is pinned per rotation over the control port, so the
+        # torrc is left alone and --countries only narrows the candidates.
+        if args.countries and _country_plan is None:
+            countries = filter_countries_with_exits(args.countries.split(','))
+    elif _country_plan is None:
+        if not args.countries:
+            selected_country = random.choice(filter_countries_with_exits(predefined_countries))
+            countries = [selected_country]
+            print(f"Randomly selected country: {selected_country}")
+        else:
+            countries = filter_countries_with_exits(args.countries.split(','))
+
+    if args.exit_mode == 'fast':
+        THROUGHPUT_URL = args.throughput_url
+        _exit_selector = ExitSelector(countries=countries, min_bandwidth=args.min_bandwidth)
+        print(f"{white} [{green}+{white}]{green} Fast exit mode: {white}{len(_exit_selector.candidates())}{green} exits at or above {white}{args.min_bandwidth} kB/s{reset}")
 
     print_banner()
-    initialize_environment()
-    change_ip_repeatedly(args.interval, args.count)
+    # Seeding only helps before Tor reads its DataDirectory at startup.
+    check_consensus(seed=not is_tor_running())
+    initialize_environment(start_tor=not args.supervise)
+    wait_ready = args.wait_ready
+    if args.supervise:
+        if start_supervised_tor(args.tor_user) is None:
+            exit(1)
+        # Nothing can be configured over the control port before the child is up.
+        SUPERVISE_WAIT = wait_ready = wait_ready or SUPERVISE_WAIT
+    if wait_ready and not wait_for_tor(wait_ready):
+        stop_supervised_tor()
+        exit(1)
+    if args.exit_mode != 'fast' and _country_plan is None:
+        _exit_countries = countries
+        set_exit_countries(countries, persist=args.persist_countries)
+    # Long-running modes keep the relay index current from control events.
+    track_consensus()
+    reset_stream_attachment()
+    if args.warm_circuits > 0:
+        sticky = StickyRoutes(args.sticky_ttl, args.sticky_hosts) if args.sticky_ttl > 0 else None
+        try:
+            _circuit_pool = CircuitPool(get_controller(), size=args.warm_circuits, sticky=sticky,
+                                        countries=_country_plan.countries if _country_plan else None).start()
+            print(f"{white} [{green}+{white}]{green} Keeping {white}{args.warm_circuits}{green} warm circuits per country ready for rotation{reset}")
+            if sticky is not None:
+                print(f"{white} [{green}+{white}]{green} Destination hosts keep their circuit until idle for {white}{args.sticky_ttl:g}s{reset}")
+        except TorControlError as e:
+            print(f"{white} [{red}!{white}] {red}Warm and sticky circuits need the control port: {e}{reset}")
+    try:
+        if args.command == 'serve':
+            serve(args.socket, args.http)
+        else:
+            change_ip_repeatedly(args.interval, args.count, args.jitter)
+    finally:
+        stop_circuit_pool()
+        stop_supervised_tor()
 
 if __name__ == "__main__":
     # Quick internet check but don't block
@@ -1,4 +1,5 @@
 import os
+import shutil
 import subprocess
 import platform
 
@@ -53,20 +54,86 @@ def install_tor():
             subprocess.check_output('sudo apt install tor -y', shell=True)
             print("tor installed successfully.")
 
-def update_torrc_with_countries(countries):
+TORRC_PATH = os.environ.get('TORNET_TORRC', '/etc/tor/torrc')
+# Managed include holding the persisted exit settings; rewritten in place,
+# never appended to.
+TORRC_INCLUDE_PATH = os.environ.get('TORNET_TORRC_INCLUDE', '/etc/tor/torrc.d/tornet.conf')
+
+def format_exit_nodes(countries):
+    """
+    Build an ExitNodes value from country codes, e.g. ['us', 'DE'] ->
+    '{us},{de}'. Entries that are already braced or are $fingerprints are
+    kept as they are.
+    """
+    nodes = []
+    for country in countries:
+        country = country.strip()
+        if not country:
+            continue
+        if country.startswith(('{', '$')):
+            nodes.append(country)
+        else:
+            nodes.append(f"{{{country.lower()}}}")
+    return ",".join(nodes)
+
+def _write_if_changed(path, content):
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(content)
+    # Keep the replaced file's owner and mode (the torrc is often root:root 0644
+    # or owned by the tor user).
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    if st is not None:
+        shutil.copymode(path, tmp)
+        try:
+            os.chown(tmp, st.st_uid, st.st_gid)
+        except OSError:
+            pass
+    os.replace(tmp, path)
+    return True
+
+def update_torrc_with_countries(countries, torrc_path=None, include_path=None):
     """
-    Update the torrc file to specify exit nodes for the given countries.
+    Persist exit countries to the managed include file and make sure the
+    torrc includes it exactly once. Running it again with the same
+    countries changes nothing; an empty list clears the restriction.
+    Returns True if a file was modified.
 
     :param countries: A list of country codes (e.g., ['us', 'de', 'fr'])
     """
-    torrc_path = "/etc/tor/torrc"
-    exit_nodes = ",".join([f"{{{country}}}" for country in countries])
+    torrc_path = torrc_path or TORRC_PATH
+    include_path = include_path or TORRC_INCLUDE_PATH
+    exit_nodes = format_exit_nodes(countries)
+    content = "# Managed by tornet; changes will be overwritten.\n"
+    if exit_nodes:
+        content += f"ExitNodes {exit_nodes}\nStrictNodes 1\n"
+    include_line = f"%include {include_path}"
     try:
-        with open(torrc_path, "a") as torrc_file:
-            torrc_file.write(f"\nExitNodes {exit_nodes}\nStrictNodes 1\n")
-        print(f"Updated torrc with countries: {', '.join(countries)}")
+        changed = _write_if_changed(include_path, content)
+        with open(torrc_path) as f:
+            torrc = f.read()
+        if include_line not in torrc.splitlines():
+            if torrc and not torrc.endswith("\n"):
+                torrc += "\n"
+            changed = _write_if_changed(torrc_path, torrc + include_line + "\n") or changed
+        print(f"Persisted exit countries to {include_path}: {exit_nodes or 'any'}")
+        return changed
     except PermissionError:
         print("Permission denied: Please run the program with sudo to modify the torrc file.")
+        return False
+    except OSError as e:
+        print(f"Could not update the torrc: {e}")
+        return False
 
 if __name__ == "__main__":
     install_pip()